@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+
+import argparse
+from utils.chronobox import write_store
+
+parser = argparse.ArgumentParser(
+    description="""Convert a Chronobox timestamps CSV file into a Chronobox store.
+All scripts that take a Chronobox CSV file also accept a Chronobox store, which
+is much faster to read (especially when only a few channels are needed).""",
+)
+parser.add_argument("chronobox_csv", help="path to the Chronobox timestamps CSV file")
+parser.add_argument("output", help="write output to `OUTPUT`")
+args = parser.parse_args()
+
+write_store(args.chronobox_csv, args.output)
@@ -1,48 +1,201 @@
 #!/usr/bin/env python3
 
 import argparse
-import matplotlib.pyplot as plt
-import numpy as np
-import polars as pl
+import math
+import os
+from utils.constants import KNOWN_CHRONOBOXES
+
+# NumPy, Polars, and Matplotlib are only imported once the arguments are parsed,
+# so `--help` and usage errors return right away.
+
+
+def channel_selector(selector: str) -> tuple[str, int]:
+    board, _, channel = selector.partition(":")
+    return board, int(channel)
+
 
 parser = argparse.ArgumentParser(
-    description="Visualize the Chronobox timestamps for a single run.",
+    description="""Visualize the Chronobox timestamps for a single run.
+All selected channels are read in a single pass over the CSV file. A single
+channel is plotted on its own, multiple channels are plotted as small multiples
+(or each to its own file with --output-dir).""",
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
 )
-parser.add_argument("chronobox_csv", help="path to the Chronobox timestamps CSV file")
-parser.add_argument("board_name", help="board name (e.g. 'cb01')")
-parser.add_argument("channel_number", type=int, help="channel number")
+parser.add_argument(
+    "chronobox_csv",
+    help="path to the Chronobox timestamps CSV file (or Chronobox store)",
+)
+parser.add_argument("board_name", nargs="?", help="board name (e.g. 'cb01')")
+parser.add_argument("channel_number", nargs="?", type=int, help="channel number")
+parser.add_argument(
+    "--channel",
+    action="append",
+    default=[],
+    type=channel_selector,
+    help="additional BOARD:CHANNEL to plot (e.g. 'cb01:3', can be used multiple times)",
+)
+parser.add_argument(
+    "--channel-name",
+    action="append",
+    default=[],
+    help="additional channel to plot by its ODB name (can be used multiple times)",
+)
+parser.add_argument(
+    "--all-channels", action="store_true", help="plot all channels with hits"
+)
+parser.add_argument(
+    "--odb-json",
+    help="path to the ODB JSON file (to resolve and label channels by name)",
+)
 parser.add_argument("--output", help="write output to `OUTPUT`")
+parser.add_argument(
+    "--output-dir", help="write one `BOARD_chCHANNEL.png` file per channel to `DIR`"
+)
 parser.add_argument("--t-bins", type=int, default=100, help="number of bins along t")
 parser.add_argument(
     "--t-max", type=float, default=float("inf"), help="maximum time in seconds"
 )
 parser.add_argument("--t-min", type=float, default=0.0, help="minimum time in seconds")
+parser.add_argument(
+    "--time-index",
+    action="store_true",
+    help="""only parse the part of the CSV file within [t-min, t-max] (uses a time
+index next to the CSV file, built if missing or outdated)""",
+)
 args = parser.parse_args()
 
-df = pl.read_csv(args.chronobox_csv, comment_prefix="#").filter(
-    pl.col("board") == args.board_name,
-    pl.col("channel") == args.channel_number,
-    pl.col("chronobox_time").is_between(args.t_min, args.t_max),
-    pl.col("leading_edge"),
+channels = list(args.channel)
+if args.board_name is not None:
+    if args.channel_number is None:
+        parser.error("the following arguments are required: channel_number")
+    channels.insert(0, (args.board_name, args.channel_number))
+if args.channel_name and args.odb_json is None:
+    parser.error("--channel-name requires --odb-json")
+if not (channels or args.channel_name or args.all_channels):
+    parser.error("no channels selected")
+
+for board, _ in channels:
+    if board not in KNOWN_CHRONOBOXES:
+        parser.error(f"unknown board `{board}`")
+
+from utils.plotting import check_display, import_pyplot
+
+check_display(parser, args.output is None and args.output_dir is None)
+
+import numpy as np
+import polars as pl
+from utils.chronobox import (
+    CHRONOBOX_CHANNELS_POINTERS,
+    chronobox_channels,
+    read_channels,
+)
+from utils.odb import load_odb
+
+names = {}
+if args.odb_json is not None:
+    channels_df = chronobox_channels(
+        load_odb(args.odb_json, CHRONOBOX_CHANNELS_POINTERS)
+    )
+    names = {(board, channel): name for board, channel, name, _ in channels_df.rows()}
+    for name in args.channel_name:
+        matches = channels_df.filter(pl.col("channel_name") == name)
+        if matches.height == 0:
+            parser.error(f"channel `{name}` not found in the ODB")
+        channels.extend(matches.select("board", "channel").rows())
+
+if args.all_channels:
+    channels = None
+else:
+    # Remove duplicates, but keep the order given by the user.
+    channels = list(dict.fromkeys(channels))
+
+df = read_channels(
+    args.chronobox_csv, channels, args.t_min, args.t_max, args.time_index
 )
+if channels is None:
+    channels = df.select("board", "channel").unique().sort("board", "channel").rows()
 
 t_max = args.t_max if args.t_max < float("inf") else df["chronobox_time"].max()
 t_edges, t_bin_width = np.linspace(args.t_min, t_max, args.t_bins + 1, retstep=True)
-text = "\n".join(
-    [
-        r"$\bf{Bin\ width:}$" + f" {t_bin_width:.2E} s",
-        r"$\bf{Number\ of\ hits:}$" + f" {len(df)}",
-    ]
-)
+# Histogram all channels at once. Same bins as `np.histogram` (all half-open
+# except the last one).
+hits = df.join(
+    pl.DataFrame(
+        channels, schema=df.select("board", "channel").schema, orient="row"
+    ).with_row_index("group"),
+    on=["board", "channel"],
+).select("group", "chronobox_time")
+t_bin = np.searchsorted(t_edges, hits["chronobox_time"].to_numpy(), side="right") - 1
+t_bin = np.minimum(t_bin, args.t_bins - 1)
+hists = np.bincount(
+    hits["group"].to_numpy().astype(np.int64) * args.t_bins + t_bin,
+    minlength=len(channels) * args.t_bins,
+).reshape(len(channels), args.t_bins)
+num_hits = df.group_by("board", "channel").len()
+num_hits = {(board, channel): n for board, channel, n in num_hits.rows()}
+
+plt = import_pyplot(args.output is None and args.output_dir is None)
 
-plt.hist(df["chronobox_time"], bins=t_edges)
-plt.xlabel("Chronobox time [s]")
-plt.ylabel("Counts")
-plt.figtext(0.005, 0.01, text, fontsize=6)
-plt.tight_layout()
 
-if args.output:
-    plt.savefig(args.output)
+def title(board: str, channel: int) -> str:
+    name = names.get((board, channel))
+    return f"{board} ch{channel}" + ("" if name is None else f" ({name})")
+
+
+if args.output_dir is not None:
+    os.makedirs(args.output_dir, exist_ok=True)
+    for (board, channel), hist in zip(channels, hists):
+        fig, ax = plt.subplots()
+        ax.hist(t_edges[:-1], bins=t_edges, weights=hist)
+        ax.set(xlabel="Chronobox time [s]", ylabel="Counts")
+        ax.set_title(title(board, channel))
+        text = "\n".join(
+            [
+                r"$\bf{Bin\ width:}$" + f" {t_bin_width:.2E} s",
+                r"$\bf{Number\ of\ hits:}$" + f" {num_hits.get((board, channel), 0)}",
+            ]
+        )
+        fig.text(0.005, 0.01, text, fontsize=6)
+        fig.tight_layout()
+        fig.savefig(os.path.join(args.output_dir, f"{board}_ch{channel}.png"))
+        plt.close(fig)
+elif len(channels) == 1:
+    text = "\n".join(
+        [
+            r"$\bf{Bin\ width:}$" + f" {t_bin_width:.2E} s",
+            r"$\bf{Number\ of\ hits:}$" + f" {len(df)}",
+        ]
+    )
+
+    plt.hist(t_edges[:-1], bins=t_edges, weights=hists[0])
+    plt.xlabel("Chronobox time [s]")
+    plt.ylabel("Counts")
+    plt.figtext(0.005, 0.01, text, fontsize=6)
+    plt.tight_layout()
 else:
-    plt.show()
+    ncols = math.ceil(math.sqrt(len(channels)))
+    nrows = math.ceil(len(channels) / ncols)
+    fig, axs = plt.subplots(
+        nrows, ncols, figsize=(3 * ncols, 2 * nrows), squeeze=False, sharex=True
+    )
+    for ax, (board, channel), hist in zip(axs.flat, channels, hists):
+        # A single artist per channel (instead of a patch per bin) keeps drawing
+        # hundreds of channels fast.
+        ax.stairs(hist, t_edges, fill=True)
+        ax.set_title(
+            f"{title(board, channel)}: {num_hits.get((board, channel), 0)} hits",
+            fontsize=8,
+        )
+        ax.tick_params(labelsize=6)
+    for ax in axs.flat[len(channels) :]:
+        ax.axis("off")
+    fig.supxlabel("Chronobox time [s]")
+    fig.supylabel("Counts")
+    fig.text(0.005, 0.005, r"$\bf{Bin\ width:}$" + f" {t_bin_width:.2E} s", fontsize=6)
+    fig.tight_layout()
+
+if args.output_dir is None:
+    if args.output:
+        plt.savefig(args.output)
+    else:
+        plt.show()
@@ -1,25 +1,84 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ProcessPoolExecutor
 from jsonpointer import resolve_pointer
 import argparse
+import csv
 import json
+import sys
+from utils.odb import load_odb, resolve_wildcard_pointer
 
-parser = argparse.ArgumentParser(description="Extract information from the ODB")
-parser.add_argument("odb_json", help="path to the ODB JSON file")
-parser.add_argument(
-    "json_pointer",
-    help="JSON pointer to resolve (e.g. /Equipment/cbtrg/Settings/names/0)",
-)
-parser.add_argument("--pretty", action="store_true", help="pretty print the output")
-args = parser.parse_args()
-
-with open(args.odb_json) as f:
-    # First 2 lines are comments
-    json_string = f.read().split("\n", 2)[2]
-    odb = json.loads(json_string)
-
-    result = resolve_pointer(odb, args.json_pointer, None)
-    if args.pretty:
-        print(json.dumps(result, indent=4))
+
+def query(odb_json: str, pointers: list[str]) -> list[tuple[str, str, object]]:
+    # Each file is parsed only once, no matter how many pointers are resolved.
+    odb = load_odb(odb_json, pointers)
+
+    rows = []
+    for pointer in pointers:
+        if "*" in pointer:
+            for match, value in resolve_wildcard_pointer(odb, pointer):
+                rows.append((odb_json, match, value))
+        else:
+            rows.append((odb_json, pointer, resolve_pointer(odb, pointer, None)))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Extract information from the ODB.
+If multiple files or pointers are given (or a pointer has wildcards), write
+output as a table with the following columns:
+file,pointer,value
+where `value` is JSON encoded.""",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("odb_json", nargs="+", help="path to the ODB JSON file(s)")
+    parser.add_argument(
+        "json_pointer",
+        help="""JSON pointer to resolve (e.g. /Equipment/cbtrg/Settings/names/0).
+A `*` matches anything within a reference token (e.g. /Equipment/cb*/Settings/names)""",
+    )
+    parser.add_argument(
+        "--pointer",
+        action="append",
+        default=[],
+        help="additional JSON pointer to resolve (can be used multiple times)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "jsonl"],
+        default="csv",
+        help="output format for tables (default: csv)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="number of files to process in parallel"
+    )
+    parser.add_argument("--pretty", action="store_true", help="pretty print the output")
+    args = parser.parse_args()
+
+    pointers = [args.json_pointer] + args.pointer
+    if len(args.odb_json) == 1 and len(pointers) == 1 and "*" not in pointers[0]:
+        [(_, _, result)] = query(args.odb_json[0], pointers)
+        if args.pretty:
+            print(json.dumps(result, indent=4))
+        else:
+            print(result)
+        sys.exit()
+
+    if len(args.odb_json) == 1:
+        results = [query(args.odb_json[0], pointers)]
     else:
-        print(result)
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = executor.map(
+                query, args.odb_json, [pointers] * len(args.odb_json)
+            )
+
+    writer = csv.writer(sys.stdout) if args.format == "csv" else None
+    if writer is not None:
+        writer.writerow(["file", "pointer", "value"])
+    for rows in results:
+        for file, pointer, value in rows:
+            if writer is not None:
+                writer.writerow([file, pointer, json.dumps(value)])
+            else:
+                print(json.dumps({"file": file, "pointer": pointer, "value": value}))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import contextlib
+import os
+import signal
+import sys
+import threading
+from utils.cache import add_cache_arguments, result_cache
+from utils.chronobox import (
+    CHRONOBOX_CHANNELS_POINTERS,
+    chronobox_channels,
+    is_store,
+    read_leading_edges,
+)
+from utils.follow import SpillLogFollower
+from utils.odb import load_odb
+from utils.sequencer import read_sequencer_csv, sequencer_events
+from utils.readers import read_csv
+from utils.schemas import TRG_SCALERS_SCHEMA
+from utils.spill_log import dump_windows, spill_log
+
+parser = argparse.ArgumentParser(
+    description="""Generate the spill log for a single run directly from the
+sequencer CSV file (i.e. sequencer.py followed by spill_log.py in one process).""",
+)
+parser.add_argument("sequencer_csv", help="path to the sequencer CSV file")
+parser.add_argument("odb_json", help="path to the ODB JSON file")
+parser.add_argument(
+    "chronobox_csv",
+    help="path to the Chronobox timestamps CSV file (or Chronobox store)",
+)
+parser.add_argument("trg_scalers_csv", help="path to the TRG scalers CSV file")
+parser.add_argument("--output", help="write output to `OUTPUT`")
+parser.add_argument(
+    "--sequencer-events-output",
+    help="also write the sequencer events (same as sequencer.py) to `SEQUENCER_EVENTS_OUTPUT`",
+)
+parser.add_argument(
+    "--follow",
+    type=float,
+    metavar="SECONDS",
+    help="""keep following the (growing) files of a run that is still being
+taken, appending new spill log rows every `SECONDS` until interrupted (Ctrl-C
+writes the remaining rows and exits)""",
+)
+add_cache_arguments(parser)
+args = parser.parse_args()
+
+if args.follow is not None:
+    if args.sequencer_events_output:
+        parser.error("--sequencer-events-output is not supported with --follow")
+    if os.path.exists(args.chronobox_csv) and is_store(args.chronobox_csv):
+        parser.error("--follow requires a Chronobox CSV file (not a store)")
+
+    follower = SpillLogFollower(
+        args.sequencer_csv, args.odb_json, args.chronobox_csv, args.trg_scalers_csv
+    )
+    output = (
+        open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout)
+    )
+    # Ctrl-C means that the run is over (i.e. everything that is left is final).
+    # Only check for it between refreshes, so a refresh is never cut in half.
+    interrupted = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: interrupted.set())
+    with output as f:
+        include_header = True
+        final = False
+        while not final:
+            if not include_header:
+                final = interrupted.wait(args.follow)
+            spill_log_df = follower.refresh(final)
+            if include_header or spill_log_df.height > 0:
+                spill_log_df.write_csv(f, include_header=include_header)
+                f.flush()
+                include_header = False
+    sys.exit()
+
+cache = result_cache(args)
+if cache is not None:
+    # Same key as sequencer.py, so results are shared between both scripts.
+    events_key = cache.key(
+        "sequencer_events", [args.sequencer_csv, args.odb_json, args.chronobox_csv]
+    )
+    spill_log_key = cache.key(
+        "pipeline_spill_log",
+        [args.sequencer_csv, args.odb_json, args.chronobox_csv, args.trg_scalers_csv],
+    )
+events_df = None if cache is None else cache.get(events_key)
+spill_log_df = None if cache is None else cache.get(spill_log_key)
+
+if spill_log_df is None or (events_df is None and args.sequencer_events_output):
+    # All inputs are independent of each other. Polars releases the GIL while
+    # reading the CSV files, so the (pure Python) XML parsing and ODB loading
+    # overlap with the Chronobox and TRG ingest.
+    with ThreadPoolExecutor() as executor:
+        chronobox_future = executor.submit(read_leading_edges, args.chronobox_csv)
+        trg_scalers_future = executor.submit(
+            read_csv, args.trg_scalers_csv, TRG_SCALERS_SCHEMA
+        )
+        if events_df is None:
+            sequencer_future = executor.submit(read_sequencer_csv, args.sequencer_csv)
+        odb_future = executor.submit(
+            load_odb, args.odb_json, CHRONOBOX_CHANNELS_POINTERS
+        )
+
+        channels_df = chronobox_channels(odb_future.result())
+        chronobox_df = chronobox_future.result()
+        if events_df is None:
+            events_df = sequencer_events(
+                sequencer_future.result(), chronobox_df, channels_df
+            )
+            if cache is not None:
+                cache.put(events_key, events_df)
+
+        spill_log_df = spill_log(
+            dump_windows(events_df),
+            channels_df,
+            [chronobox_df],
+            [trg_scalers_future.result()],
+        )
+    if cache is not None:
+        cache.put(spill_log_key, spill_log_df)
+
+if args.sequencer_events_output:
+    events_df.write_csv(args.sequencer_events_output)
+if args.output:
+    spill_log_df.write_csv(args.output)
+else:
+    print(spill_log_df.write_csv())
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import socket
+import sys
+from utils.query import (
+    QUERY_SCRIPTS,
+    add_socket_argument,
+    receive_message,
+    send_message,
+)
+
+parser = argparse.ArgumentParser(
+    description="""Run a script through the query server (see query_server.py),
+which keeps the data of recently used runs in memory. The arguments are the
+same as running the script directly (e.g. `query.py vertices.py run.csv --output
+vertices.png`), except that plots must be written to a file.""",
+)
+add_socket_argument(parser)
+parser.add_argument("script", choices=QUERY_SCRIPTS, help="script to run")
+parser.add_argument(
+    "args", nargs=argparse.REMAINDER, help="arguments passed to the script"
+)
+args = parser.parse_args()
+
+with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    try:
+        sock.connect(args.socket)
+    except OSError as e:
+        sys.exit(f"error connecting to the query server at `{args.socket}`: {e}")
+    send_message(sock, {"script": args.script, "args": args.args, "cwd": os.getcwd()})
+    response = receive_message(sock)
+
+if response is None:
+    sys.exit("error: the query server closed the connection")
+sys.stdout.write(response["stdout"])
+sys.stderr.write(response["stderr"])
+sys.exit(response["exit_code"])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import runpy
+import socket
+import sys
+import time
+import traceback
+from utils.memory import MemoryCache, set_memory_cache
+from utils.plotting import set_headless
+from utils.query import (
+    QUERY_SCRIPTS,
+    add_socket_argument,
+    receive_message,
+    send_message,
+)
+
+
+def check_request(request):
+    # Requests come from anyone who can connect to the socket. A malformed one
+    # must not take the server down.
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+    if not isinstance(request.get("script"), str):
+        raise ValueError("`script` must be a string")
+    args = request.get("args")
+    if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        raise ValueError("`args` must be a list of strings")
+    if not isinstance(request.get("cwd"), str):
+        raise ValueError("`cwd` must be a string")
+
+
+def run_script(script: str, args: list[str], cwd: str) -> dict:
+    # Exactly the same as running the script from `cwd`, except that all the
+    # modules are already imported and the input files are (probably) already
+    # in memory.
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    previous_cwd, previous_argv = os.getcwd(), sys.argv
+    try:
+        os.chdir(cwd)
+        sys.argv = [script] + args
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                runpy.run_path(
+                    os.path.join(os.path.dirname(__file__), script),
+                    run_name="__main__",
+                )
+            except SystemExit as e:
+                if isinstance(e.code, str):
+                    print(e.code, file=sys.stderr)
+                    exit_code = 1
+                else:
+                    exit_code = e.code or 0
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+    finally:
+        os.chdir(previous_cwd)
+        sys.argv = previous_argv
+        # Figures are never shown, don't keep them around.
+        if "matplotlib.pyplot" in sys.modules:
+            sys.modules["matplotlib.pyplot"].close("all")
+
+    return {
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+        "exit_code": exit_code,
+    }
+
+
+def bind(path: str) -> socket.socket:
+    if os.path.exists(path):
+        # Only replace the socket of a server that is not running anymore.
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                os.remove(path)
+            else:
+                raise RuntimeError(f"a query server is already listening on `{path}`")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Nobody else gets to run scripts as this user.
+    previous_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(previous_umask)
+    server.listen()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=f"""Keep the data of recently used runs in memory, and run
+queries (see query.py) against it. Each query is one of the following scripts
+with its usual arguments: {", ".join(QUERY_SCRIPTS)}. Input files are parsed
+once, and kept in memory (least recently used files are evicted first) until
+they change. Plots are rendered without a display, i.e. they must be written
+to a file (e.g. with --output).""",
+    )
+    add_socket_argument(parser)
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=8.0,
+        help="maximum size of the data kept in memory in GB (default: 8)",
+    )
+    args = parser.parse_args()
+
+    cache = MemoryCache(int(args.max_memory * 1e9))
+    set_memory_cache(cache)
+    set_headless()
+    # Worker processes (e.g. vertices.py with multiple files) can't be forked
+    # from a process that already has a Polars thread pool.
+    multiprocessing.set_start_method("spawn")
+
+    server = bind(args.socket)
+    print(f"Listening on `{args.socket}`.", file=sys.stderr)
+    try:
+        # One query at a time. Pyplot is not thread-safe, and all queries
+        # share the same memory anyway.
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    request = receive_message(connection)
+                    if request is None:
+                        continue
+                    check_request(request)
+                    start = time.perf_counter()
+                    if request["script"] not in QUERY_SCRIPTS:
+                        response = {
+                            "stdout": "",
+                            "stderr": f"unknown script `{request['script']}`\n",
+                            "exit_code": 2,
+                        }
+                    else:
+                        response = run_script(
+                            request["script"], request["args"], request["cwd"]
+                        )
+                    send_message(connection, response)
+                # Whatever goes wrong with one connection, keep serving the
+                # next ones.
+                except Exception as e:
+                    print(f"Bad request: {e!r}", file=sys.stderr)
+                    continue
+            print(
+                f"{request['script']} {' '.join(request['args'])}: exit code "
+                f"{response['exit_code']} in {time.perf_counter() - start:.3f} s "
+                f"({cache.size / 1e6:.1f} MB in memory)",
+                file=sys.stderr,
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(args.socket)
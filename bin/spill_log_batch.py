@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import argparse
+import multiprocessing
+import os
+import polars as pl
+import sys
+import traceback
+from utils.cache import ResultCache, add_cache_arguments
+from utils.readers import read_csv
+from utils.schemas import SPILL_LOG_MANIFEST_SCHEMA
+from utils.spill_log import run_spill_log
+
+INPUT_COLUMNS = ["sequencer_events_csv", "odb_json", "chronobox_csv", "trg_scalers_csv"]
+# Columns of the combined spill log (besides the channel counts).
+EMPTY_SCHEMA = {
+    "run_number": pl.UInt32,
+    "sequencer_name": pl.String,
+    "event_description": pl.String,
+    "start_time": pl.Float64,
+    "stop_time": pl.Float64,
+    "trg_approx_input": pl.Int64,
+}
+
+
+def run(
+    run_number: int,
+    inputs: list[str],
+    cache_dir: Optional[str],
+    cache_size: int,
+    streaming: bool,
+    chunk_size: int,
+) -> tuple[int, Optional[pl.DataFrame], Optional[str]]:
+    # A failing run shouldn't abort the whole batch. Just report it back.
+    try:
+        for path in inputs:
+            # Otherwise this shows up as an obscure error from the lazy query.
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"no such file `{path}`")
+        cache = None if cache_dir is None else ResultCache(cache_dir, cache_size)
+        spill_log_df = run_spill_log(*inputs, cache, streaming, chunk_size)
+        return run_number, spill_log_df, None
+    except Exception as error:
+        print(f"Run {run_number} failed:\n{traceback.format_exc()}", file=sys.stderr)
+        return run_number, None, f"{type(error).__name__}: {error}".splitlines()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Generate the spill log of many runs.
+The manifest is a CSV file with one row per run and the following columns:
+run_number,sequencer_events_csv,odb_json,chronobox_csv,trg_scalers_csv
+(relative paths are relative to the manifest). The output is a single spill log
+with an extra `run_number` column. Runs that fail are reported, but don't stop
+the rest of the batch.""",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("manifest_csv", help="path to the manifest CSV file")
+    parser.add_argument("--output", help="write output to `OUTPUT`")
+    parser.add_argument(
+        "--failures", help="write a run_number,error CSV of failed runs to `FAILURES`"
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="number of runs to process in parallel"
+    )
+    parser.add_argument(
+        "--threads-per-job",
+        type=int,
+        help="number of Polars threads of each job (default: CPUs / jobs)",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="process the Chronobox and TRG files in chunks (for runs larger than RAM)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1_000_000,
+        help="number of rows per chunk in streaming mode",
+    )
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    manifest_df = read_csv(args.manifest_csv, SPILL_LOG_MANIFEST_SCHEMA)
+    manifest_dir = os.path.dirname(args.manifest_csv)
+    manifest_df = manifest_df.with_columns(
+        pl.col(INPUT_COLUMNS).map_elements(
+            lambda path: os.path.join(manifest_dir, path), return_dtype=pl.String
+        )
+    )
+
+    num_cpus = os.cpu_count() or 1
+    jobs = max(1, min(args.jobs or num_cpus, manifest_df.height))
+    threads = args.threads_per_job or max(1, num_cpus // jobs)
+    # Every worker would otherwise start a Polars thread pool as large as the
+    # whole machine. This has to be set before the workers start, and the
+    # workers have to be spawned (not forked) because Polars is not fork-safe.
+    os.environ["POLARS_MAX_THREADS"] = str(threads)
+
+    frames, failures = [], []
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        results = executor.map(
+            run,
+            manifest_df["run_number"],
+            manifest_df.select(INPUT_COLUMNS).rows(),
+            [args.cache_dir] * manifest_df.height,
+            [int(args.cache_size * 1e9)] * manifest_df.height,
+            [args.streaming] * manifest_df.height,
+            [args.chunk_size] * manifest_df.height,
+        )
+        for run_number, spill_log_df, error in results:
+            if error is not None:
+                failures.append((run_number, error))
+            else:
+                frames.append(
+                    spill_log_df.select(
+                        pl.lit(run_number, dtype=pl.UInt32).alias("run_number"),
+                        pl.all(),
+                    )
+                )
+
+    if frames:
+        spill_log_df = pl.concat(frames, how="diagonal_relaxed")
+    else:
+        spill_log_df = pl.DataFrame(schema=EMPTY_SCHEMA)
+    # Every run only has columns for the channels with hits (i.e. a missing
+    # column is just 0 counts).
+    channels = sorted(set(spill_log_df.columns) - set(EMPTY_SCHEMA))
+    spill_log_df = spill_log_df.select(
+        pl.col(list(EMPTY_SCHEMA)[:-1]),
+        pl.col(channels).fill_null(0),
+        "trg_approx_input",
+    )
+
+    if args.output:
+        spill_log_df.write_csv(args.output)
+    else:
+        print(spill_log_df.write_csv())
+
+    if args.failures:
+        pl.DataFrame(
+            failures, schema={"run_number": pl.UInt32, "error": pl.String}, orient="row"
+        ).write_csv(args.failures)
+    if failures:
+        sys.exit(1)
@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
-from matplotlib.lines import Line2D
-import matplotlib.pyplot as plt
-import numpy as np
-import polars as pl
+
+# NumPy, Polars, and Matplotlib are only imported once the arguments are parsed,
+# so `--help` and usage errors return right away.
 
 parser = argparse.ArgumentParser(
     description="Visualize the TRG scalers for a single run.",
@@ -17,6 +16,12 @@ parser.add_argument(
     "--t-max", type=float, default=float("inf"), help="maximum time in seconds"
 )
 parser.add_argument("--t-min", type=float, default=0.0, help="minimum time in seconds")
+parser.add_argument(
+    "--time-index",
+    action="store_true",
+    help="""only parse the part of the CSV file within [t-min, t-max] (uses a time
+index next to the CSV file, built if missing or outdated)""",
+)
 parser.add_argument("--include-drift-veto-counter", action="store_true")
 parser.add_argument("--include-pulser-counter", action="store_true")
 parser.add_argument("--include-scaledown-counter", action="store_true")
@@ -24,6 +29,50 @@ parser.add_argument("--remove-input-counter", action="store_true")
 parser.add_argument("--remove-output-counter", action="store_true")
 args = parser.parse_args()
 
+from utils.plotting import check_display, import_pyplot
+
+check_display(parser, args.output is None)
+
+import numpy as np
+import polars as pl
+from utils.readers import read_csv
+from utils.schemas import TRG_SCALERS_SCHEMA
+from utils.time_index import read_time_range
+
+
+def spread_histogram(
+    t_left: np.ndarray, step: np.ndarray, counts: np.ndarray, edges: np.ndarray
+) -> np.ndarray:
+    """Histogram the times `t_left + step * i` for all `i` in `1..=counts`.
+
+    The intervals must be sorted and non-overlapping. This gives exactly the same
+    result as `np.histogram` of all the individual times, but without having to
+    materialize them (i.e. in O(len(counts) + len(edges)) memory).
+    """
+    if counts.size == 0:
+        return np.zeros(edges.size - 1, dtype=np.int64)
+    cumulative = np.concatenate(([0], np.cumsum(counts)))
+
+    def num_times(edges: np.ndarray, less) -> np.ndarray:
+        # All intervals before `k` are completely below the edge, and the edge
+        # can only split interval `k`.
+        k = np.searchsorted(t_left, edges, side="left") - 1
+        outside = k < 0
+        k[outside] = 0
+        tl, st, c = t_left[k], step[k], counts[k]
+        i = np.clip(np.floor((edges - tl) / st), 0, c)
+        # Correct any rounding error such that it is consistent with the
+        # individual `t_left + step * i` times.
+        i = np.where((i < c) & less(tl + st * (i + 1), edges), i + 1, i)
+        i = np.where((i > 0) & ~less(tl + st * i, edges), i - 1, i)
+        return np.where(outside, 0, cumulative[k] + i.astype(np.int64))
+
+    # Same as `np.histogram`, all bins are half-open except the last one.
+    below = num_times(edges, np.less)
+    below[-1] = num_times(edges[-1:], np.less_equal)[0]
+    return np.diff(below)
+
+
 columns = {
     "input": not args.remove_input_counter,
     "drift_veto": args.include_drift_veto_counter,
@@ -32,13 +81,31 @@ columns = {
     "output": not args.remove_output_counter,
 }
 
-df = pl.read_csv(args.trg_scalers_csv, comment_prefix="#").filter(
-    pl.col("trg_time").is_between(args.t_min, args.t_max)
-)
+read_columns = ["trg_time"] + [name for name, included in columns.items() if included]
+if args.time_index:
+    df = read_time_range(
+        args.trg_scalers_csv,
+        TRG_SCALERS_SCHEMA,
+        "trg_time",
+        args.t_min,
+        args.t_max,
+        read_columns,
+    )
+else:
+    df = read_csv(
+        args.trg_scalers_csv,
+        TRG_SCALERS_SCHEMA,
+        read_columns,
+        pl.col("trg_time").is_between(args.t_min, args.t_max),
+    )
 
 t_max = args.t_max if args.t_max < float("inf") else df["trg_time"].max()
 t_edges, t_bin_width = np.linspace(args.t_min, t_max, args.t_bins + 1, retstep=True)
 text = r"$\bf{Bin\ width:}$" + f" {t_bin_width:.2E} s"
+
+plt = import_pyplot(args.output is None)
+from matplotlib.lines import Line2D
+
 plt.figtext(0.005, 0.01, text, fontsize=8)
 
 for name, included in columns.items():
@@ -49,7 +116,7 @@ for name, included in columns.items():
     know by how much they were incremented. The best we can do is assume that
     those counts are evenly spread out over the time interval.
     """
-    times = np.array(
+    intervals = (
         df.filter(pl.col(name).is_not_null())
         .rename({"trg_time": "t_right"})
         .with_columns(
@@ -59,17 +126,27 @@ for name, included in columns.items():
         .filter(pl.col("counts") > 0)
         .select(
             "t_left",
+            "counts",
             step=((pl.col("t_right") - pl.col("t_left")) / pl.col("counts")),
-            i=pl.int_ranges(1, pl.col("counts") + 1),
         )
-        .explode("i")
-        .select(times=pl.col("t_left") + pl.col("step") * pl.col("i"))
     )
+    hist = spread_histogram(
+        intervals["t_left"].to_numpy(),
+        intervals["step"].to_numpy(),
+        intervals["counts"].to_numpy(),
+        t_edges,
+    )
+    num_counts = intervals["counts"].sum()
     if df[name][0] > 0:
-        times = np.append(df["trg_time"][0], times)
+        hist += np.histogram(df["trg_time"][0], bins=t_edges)[0]
+        num_counts += 1
 
     plt.hist(
-        times, bins=t_edges, histtype="step", label=f"{name} ({times.size} counts)"
+        t_edges[:-1],
+        bins=t_edges,
+        weights=hist,
+        histtype="step",
+        label=f"{name} ({num_counts} counts)",
     )
 
 plt.xlabel("TRG time [s]")
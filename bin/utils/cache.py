@@ -0,0 +1,119 @@
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import os
+import polars as pl
+
+# Changing any of these modules (or the Polars version) invalidates all cached
+# results.
+_CODE_VERSION = hashlib.sha256(
+    b"".join(path.read_bytes() for path in sorted(Path(__file__).parent.glob("*.py")))
+    + pl.__version__.encode()
+).hexdigest()
+
+
+class ResultCache:
+    """On-disk cache of derived DataFrames keyed by the content of their inputs.
+
+    Entries are stored as Parquet files, and the least recently used entries are
+    evicted once the total size goes over `max_size` bytes. The content hash of
+    each input file is memoized by (path, size, modification time), so looking up
+    a result doesn't require reading large input files again.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        (self.directory / "results").mkdir(parents=True, exist_ok=True)
+        (self.directory / "digests").mkdir(parents=True, exist_ok=True)
+
+    def _file_digest(self, path: str) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        memo = self.directory / "digests" / (hashlib.sha256(path.encode()).hexdigest())
+        try:
+            cached = json.loads(memo.read_text())
+            if cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime_ns:
+                return cached["digest"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        digest = hashlib.blake2b()
+        with open(path, "rb") as f:
+            while chunk := f.read(2**24):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        self._write_atomic(
+            memo,
+            json.dumps(
+                {"size": stat.st_size, "mtime": stat.st_mtime_ns, "digest": digest}
+            ).encode(),
+        )
+        return digest
+
+    def _write_atomic(self, path: Path, data: bytes):
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def key(self, stage: str, inputs: list[str]) -> str:
+        """Return the cache key of `stage` given its input files."""
+        digest = hashlib.sha256(f"{_CODE_VERSION}\n{stage}\n".encode())
+        for path in inputs:
+            digest.update(self._file_digest(path).encode() + b"\n")
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[pl.DataFrame]:
+        path = self.directory / "results" / f"{key}.parquet"
+        try:
+            df = pl.read_parquet(path)
+        except (OSError, pl.exceptions.PolarsError):
+            return None
+        # Modification time is used to keep track of the last use.
+        os.utime(path)
+        return df
+
+    def put(self, key: str, df: pl.DataFrame):
+        path = self.directory / "results" / f"{key}.parquet"
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        df.write_parquet(tmp)
+        os.replace(tmp, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in (self.directory / "results").glob("*.parquet"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        entries.sort(reverse=True)
+
+        total = 0
+        for _, size, path in entries:
+            total += size
+            if total > self.max_size:
+                path.unlink(missing_ok=True)
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get("ALPHA_G_CACHE_DIR"),
+        help="reuse results from (and store them in) `CACHE_DIR` "
+        "(can also be set with the ALPHA_G_CACHE_DIR environment variable)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=10.0,
+        help="maximum size of the cache in GB",
+    )
+
+
+def result_cache(args) -> Optional[ResultCache]:
+    if args.cache_dir is None:
+        return None
+    return ResultCache(args.cache_dir, int(args.cache_size * 1e9))
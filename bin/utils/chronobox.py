@@ -0,0 +1,270 @@
+from typing import Iterator, Optional
+import json
+import numpy as np
+import polars as pl
+import struct
+from utils.readers import iter_csv_batches, is_compressed, read_csv, scan_csv
+from utils.constants import KNOWN_CHRONOBOXES
+from utils.schemas import BOARD, CHANNEL, CHRONOBOX_SCHEMA
+from utils.time_index import read_time_range
+
+# A Chronobox store is a binary file with all the timestamps from a Chronobox
+# CSV file grouped by (board, channel, leading_edge) and sorted by time:
+#
+#   magic (8 bytes) | header length (little-endian u64) | JSON header | padding
+#   | little-endian float64 timestamps
+#
+# The JSON header is a list of {board, channel, leading_edge, offset, length}
+# entries, where `offset` and `length` are in number of timestamps. The data
+# section is memory-mapped, so reading a single channel doesn't touch the rest
+# of the file.
+STORE_MAGIC = b"CBSTORE1"
+
+# All the ODB entries needed by `chronobox_channels`.
+CHRONOBOX_CHANNELS_POINTERS = [
+    f"/Equipment/{board}/Settings/names" for board in KNOWN_CHRONOBOXES
+]
+
+_LEADING_EDGES_SCHEMA = {
+    name: CHRONOBOX_SCHEMA[name] for name in ["board", "channel", "chronobox_time"]
+}
+
+
+def is_store(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+
+def write_store(chronobox_csv: str, path: str):
+    df = read_csv(chronobox_csv, CHRONOBOX_SCHEMA).sort(
+        "board", "channel", "leading_edge", "chronobox_time"
+    )
+    index = (
+        df.group_by("board", "channel", "leading_edge", maintain_order=True)
+        .len("length")
+        .with_columns(offset=pl.col("length").cum_sum() - pl.col("length"))
+    )
+    header = json.dumps(index.to_dicts()).encode()
+    padding = -(len(STORE_MAGIC) + 8 + len(header)) % 8
+
+    with open(path, "wb") as f:
+        f.write(STORE_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(b"\0" * padding)
+        f.write(df["chronobox_time"].to_numpy().astype("<f8").tobytes())
+
+
+class ChronoboxStore:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            if f.read(len(STORE_MAGIC)) != STORE_MAGIC:
+                raise ValueError(f"`{path}` is not a Chronobox store")
+            (header_length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+
+        self._index = {
+            (entry["board"], entry["channel"], entry["leading_edge"]): (
+                entry["offset"],
+                entry["length"],
+            )
+            for entry in header
+        }
+        data_offset = len(STORE_MAGIC) + 8 + header_length
+        data_offset += -data_offset % 8
+        if sum(length for _, length in self._index.values()) > 0:
+            self._times = np.memmap(path, dtype="<f8", mode="r", offset=data_offset)
+        else:
+            self._times = np.empty(0, dtype="<f8")
+
+    def channels(self, leading_edge: bool = True) -> list[tuple[str, int]]:
+        return [(b, c) for b, c, edge in self._index if edge == leading_edge]
+
+    def times(self, board: str, channel: int, leading_edge: bool = True) -> np.ndarray:
+        """Return a read-only view of the sorted timestamps of a single channel."""
+        offset, length = self._index.get((board, channel, leading_edge), (0, 0))
+        return self._times[offset : offset + length]
+
+    def between(
+        self,
+        board: str,
+        channel: int,
+        t_min: float,
+        t_max: float,
+        leading_edge: bool = True,
+    ) -> np.ndarray:
+        """Same as `times`, but only within the closed [t_min, t_max] interval."""
+        times = self.times(board, channel, leading_edge)
+        start = np.searchsorted(times, t_min, side="left")
+        stop = np.searchsorted(times, t_max, side="right")
+        return times[start:stop]
+
+    def count(
+        self,
+        board: str,
+        channel: int,
+        t_min: float,
+        t_max: float,
+        leading_edge: bool = True,
+    ) -> int:
+        return len(self.between(board, channel, t_min, t_max, leading_edge))
+
+
+def read_channels(
+    path: str,
+    channels: Optional[list[tuple[str, int]]],
+    t_min: float,
+    t_max: float,
+    time_index: bool = False,
+) -> pl.DataFrame:
+    """Read the leading edges of many Chronobox channels within [t_min, t_max].
+
+    Returns a board,channel,chronobox_time DataFrame with the hits of all
+    `channels` (all of them if None), all read in a single pass. `path` can be
+    either a Chronobox CSV file or a Chronobox store. If `time_index` is true, a
+    CSV file is read through its time index (see `utils.time_index`).
+    """
+    if is_store(path):
+        store = ChronoboxStore(path)
+        return pl.concat(
+            [pl.DataFrame(schema=_LEADING_EDGES_SCHEMA)]
+            + [
+                _channel_frame(
+                    board, channel, store.between(board, channel, t_min, t_max)
+                )
+                for board, channel in (
+                    store.channels() if channels is None else channels
+                )
+            ]
+        )
+
+    # The Chronobox CSV can be multiple GB for long runs. Scan it lazily so that
+    # the filters are pushed down into the reader and only the hits from the
+    # selected channels are ever held in memory.
+    predicate = pl.col("chronobox_time").is_between(t_min, t_max) & pl.col(
+        "leading_edge"
+    )
+    if channels is not None and is_compressed(path):
+        # Polars can't push the join below down into a compressed file.
+        by_board = {}
+        for board, channel in channels:
+            by_board.setdefault(board, []).append(channel)
+        predicate = predicate & pl.any_horizontal(
+            pl.lit(False),
+            *(
+                (pl.col("board") == board)
+                & pl.col("channel").is_in(pl.Series(board_channels, dtype=CHANNEL))
+                for board, board_channels in by_board.items()
+            ),
+        )
+    columns = ["board", "channel", "chronobox_time"]
+    lf = (
+        read_time_range(path, CHRONOBOX_SCHEMA, "chronobox_time", t_min, t_max)
+        .lazy()
+        .filter(predicate)
+        .select(columns)
+        if time_index
+        else scan_csv(path, CHRONOBOX_SCHEMA, columns, predicate)
+    )
+    if channels is not None:
+        lf = lf.join(
+            pl.LazyFrame(
+                channels, schema={"board": BOARD, "channel": CHANNEL}, orient="row"
+            ),
+            on=["board", "channel"],
+            how="semi",
+        )
+    return lf.collect(streaming=True)
+
+
+def read_channel(
+    path: str,
+    board: str,
+    channel: int,
+    t_min: float,
+    t_max: float,
+    time_index: bool = False,
+) -> pl.DataFrame:
+    """Same as `read_channels`, but for a single channel (only `chronobox_time`)."""
+    return read_channels(path, [(board, channel)], t_min, t_max, time_index).select(
+        "chronobox_time"
+    )
+
+
+def _channel_frame(board: str, channel: int, times: np.ndarray) -> pl.DataFrame:
+    return pl.DataFrame({"chronobox_time": times}).select(
+        board=pl.lit(board, dtype=BOARD),
+        channel=pl.lit(channel, dtype=CHANNEL),
+        chronobox_time="chronobox_time",
+    )
+
+
+def scan_leading_edges(path: str) -> pl.LazyFrame:
+    """Lazily read all leading edges as a board,channel,chronobox_time LazyFrame.
+
+    `path` can be either a Chronobox CSV file or a Chronobox store.
+    """
+    if is_store(path):
+        store = ChronoboxStore(path)
+        return pl.concat(
+            [pl.DataFrame(schema=_LEADING_EDGES_SCHEMA)]
+            + [
+                _channel_frame(board, channel, store.times(board, channel))
+                for board, channel in store.channels()
+            ]
+        ).lazy()
+
+    return scan_csv(
+        path,
+        CHRONOBOX_SCHEMA,
+        ["board", "channel", "chronobox_time"],
+        pl.col("leading_edge"),
+    )
+
+
+def read_leading_edges(path: str) -> pl.DataFrame:
+    """Read all leading edges as a board,channel,chronobox_time DataFrame.
+
+    `path` can be either a Chronobox CSV file or a Chronobox store.
+    """
+    return scan_leading_edges(path).collect()
+
+
+def iter_leading_edges(path: str, chunk_size: int) -> Iterator[pl.DataFrame]:
+    """Same as `read_leading_edges`, but in chunks of at most `chunk_size` hits.
+
+    Only a single chunk is held in memory at any time.
+    """
+    if is_store(path):
+        store = ChronoboxStore(path)
+        for board, channel in store.channels():
+            times = store.times(board, channel)
+            for i in range(0, len(times), chunk_size):
+                yield _channel_frame(board, channel, times[i : i + chunk_size])
+        return
+
+    for batch in iter_csv_batches(path, chunk_size, CHRONOBOX_SCHEMA):
+        yield batch.filter(pl.col("leading_edge")).select(
+            "board", "channel", "chronobox_time"
+        )
+
+
+def chronobox_channels(odb: dict) -> pl.DataFrame:
+    """Return a lookup table of all Chronobox channel names in the ODB.
+
+    The table has one row per (board, channel) with the following columns:
+    board,channel,channel_name,duplicate
+    where `duplicate` is true if the same name is used by more than one
+    Chronobox channel.
+    """
+    boards, channels, names = [], [], []
+    for board in KNOWN_CHRONOBOXES:
+        for channel, name in enumerate(odb["Equipment"][board]["Settings"]["names"]):
+            boards.append(board)
+            channels.append(channel)
+            names.append(name)
+
+    return pl.DataFrame(
+        {"board": boards, "channel": channels, "channel_name": names},
+        schema={"board": BOARD, "channel": CHANNEL, "channel_name": pl.String},
+    ).with_columns(duplicate=pl.len().over("channel_name") > 1)
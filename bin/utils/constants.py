@@ -0,0 +1,4 @@
+# Constants that are needed without importing Polars (e.g. to validate the
+# arguments of a script before its heavy imports).
+
+KNOWN_CHRONOBOXES = ["cb01", "cb02", "cb03", "cb04"]
@@ -0,0 +1,383 @@
+import contextlib
+import io
+import math
+import polars as pl
+import sys
+from utils.chronobox import CHRONOBOX_CHANNELS_POINTERS, chronobox_channels
+from utils.odb import load_odb
+from utils.readers import CsvFollower
+from utils.schemas import CHRONOBOX_SCHEMA, SEQUENCER_SCHEMA, TRG_SCALERS_SCHEMA
+from utils.sequencer import (
+    TOLERANCE,
+    parse_sequencer,
+    sequencer_events_with_offset,
+    warn_mismatched_markers,
+)
+from utils.spill_log import (
+    TRG_SCALERS_COLUMNS,
+    chronobox_counts,
+    dump_windows,
+    trg_approx_input,
+)
+
+# A dump window is only final once both the Chronobox and the TRG data are this
+# many seconds past its end. This gives markers written slightly out of order
+# time to show up before the window is emitted.
+SETTLE_TIME = 2 * TOLERANCE
+# The sequencer XML of a sequence is assumed to show up within this many seconds
+# (of Chronobox data) after the sequence started. Until then, its markers may be
+# attributed to the previous iteration, so a window is held back until either
+# the XML of a later iteration of its sequencer is matched or it is this old.
+MAX_SEQUENCER_LAG = 60.0
+
+_WINDOW_KEY = ["sequencer_name", "event_description", "start_time", "stop_time"]
+
+
+class _Chunks:
+    # Data appended to a CSV file, kept (with its time range) only while it can
+    # still overlap a window that has not been emitted yet.
+    def __init__(self, time_column: str):
+        self.time_column = time_column
+        self.chunks = []
+        self.latest = -math.inf
+
+    def append(self, df: pl.DataFrame):
+        times = df[self.time_column].drop_nulls()
+        if times.len() == 0:
+            return
+        self.chunks.append((times.min(), times.max(), df))
+        self.latest = max(self.latest, times.max())
+
+    def overlapping(self, t_min: float, t_max: float) -> list[pl.DataFrame]:
+        return [df for low, high, df in self.chunks if high >= t_min and low <= t_max]
+
+    def drop_before(self, t: float):
+        self.chunks = [chunk for chunk in self.chunks if chunk[1] >= t]
+
+
+class SpillLogFollower:
+    """Generate the spill log of a run while its files are still being written.
+
+    Every `refresh` only parses the bytes appended to the sequencer, Chronobox,
+    and TRG CSV files since the previous one, and returns the spill log rows of
+    the dump windows that became final in the meantime (see `SETTLE_TIME`).
+    The clock offset between the sequencer and the Chronobox is only searched
+    once, finished iterations are not matched again, and the Chronobox/TRG data
+    is dropped as soon as no open window can need it, so the cost of a refresh
+    doesn't grow over the run.
+
+    The ODB is read once. Unlike `spill_log`, there is a column for every
+    (uniquely named) channel from the start, so that all rows line up.
+    """
+
+    def __init__(
+        self,
+        sequencer_csv: str,
+        odb_json: str,
+        chronobox_csv: str,
+        trg_scalers_csv: str,
+    ):
+        self.channels_df = chronobox_channels(
+            load_odb(odb_json, CHRONOBOX_CHANNELS_POINTERS)
+        )
+        self.channel_names = sorted(
+            self.channels_df.filter(~pl.col("duplicate"))["channel_name"]
+        )
+        # Only the sequencer channels are needed to find the dump windows. These
+        # are kept for the whole run (they are just a few hits per iteration).
+        self._marker_channels_df = self.channels_df.filter(
+            pl.any_horizontal(
+                pl.col("channel_name").str.ends_with(suffix)
+                for suffix in ["_SEQ_RUNNING", "_START_DUMP", "_STOP_DUMP"]
+            )
+        ).select("board", "channel")
+
+        self._sequencer = CsvFollower(sequencer_csv, SEQUENCER_SCHEMA)
+        self._chronobox = CsvFollower(chronobox_csv, CHRONOBOX_SCHEMA)
+        self._trg = CsvFollower(
+            trg_scalers_csv, TRG_SCALERS_SCHEMA, TRG_SCALERS_COLUMNS
+        )
+
+        self._sequencer_df = parse_sequencer(pl.DataFrame(schema=SEQUENCER_SCHEMA))
+        self._markers_df = pl.DataFrame(
+            schema={
+                name: CHRONOBOX_SCHEMA[name]
+                for name in ["board", "channel", "chronobox_time"]
+            }
+        )
+        self._chronobox_chunks = _Chunks("chronobox_time")
+        self._trg_chunks = _Chunks("trg_time")
+        self._shift = None
+        # The XML,"SEQ_RUNNING" matches of the last successful `_events`.
+        self._matches_df = None
+        self._emitted_df = pl.DataFrame(
+            schema={
+                "sequencer_name": pl.String,
+                "event_description": pl.String,
+                "start_time": pl.Float64,
+                "stop_time": pl.Float64,
+            }
+        )
+        self._messages = set()
+
+    def _print_once(self, message: str):
+        if message not in self._messages:
+            self._messages.add(message)
+            print(message, file=sys.stderr)
+
+    def _events(self, final: bool, horizon: float) -> pl.DataFrame:
+        sequencer_df = self._sequencer_df
+        if self._shift is None:
+            # The latest XMLs might not have a "SEQ_RUNNING" hit yet. Give it a
+            # second try without them.
+            latest = sequencer_df["midas_timestamp"].max() or 0
+            attempts = [
+                sequencer_df,
+                sequencer_df.filter(pl.col("midas_timestamp") <= latest - SETTLE_TIME),
+            ]
+        elif final:
+            attempts = [sequencer_df]
+        else:
+            attempts = [
+                sequencer_df.filter(
+                    pl.col("midas_timestamp") - self._shift
+                    <= self._chronobox_chunks.latest - TOLERANCE
+                )
+            ]
+
+        self._matches_df = None
+        error = None
+        for sequencer_df in attempts:
+            if sequencer_df.height == 0:
+                continue
+            # `sequencer_events` reports ignored sequencers on every call. Only
+            # show them once.
+            stderr = io.StringIO()
+            try:
+                with contextlib.redirect_stderr(stderr):
+                    events_df, match = sequencer_events_with_offset(
+                        sequencer_df,
+                        self._markers_df,
+                        self.channels_df,
+                        self._shift,
+                        warn=False,
+                    )
+                    # The markers of an iteration that is still in progress can
+                    # show up before its XML, and are then (for now) attributed
+                    # to the previous iteration.
+                    warn_mismatched_markers(
+                        events_df.filter(pl.col("chronobox_time") <= horizon)
+                    )
+                self._shift = match.shift
+                self._matches_df = match.matches
+                return events_df
+            except ValueError as e:
+                error = e
+            finally:
+                for message in stderr.getvalue().splitlines():
+                    self._print_once(message)
+
+        if error is not None:
+            print(f"Waiting for more data: {error}", file=sys.stderr)
+        return pl.DataFrame(
+            schema={
+                "sequencer_name": pl.String,
+                "event_name": pl.String,
+                "event_description": pl.String,
+                "chronobox_time": pl.Float64,
+            }
+        )
+
+    def _settled(self, final: bool, horizon: float) -> float:
+        # Before this time, every sequence that started has its XML matched.
+        if final:
+            return horizon
+        return min(horizon, self._chronobox_chunks.latest - MAX_SEQUENCER_LAG)
+
+    def _ready_windows(
+        self, windows_df: pl.DataFrame, final: bool, horizon: float
+    ) -> pl.DataFrame:
+        if final:
+            return windows_df
+        # A window is only attributed to the right iteration for sure once a
+        # later iteration of its sequencer is matched, or once any XML of the
+        # iteration it belongs to would have shown up.
+        if self._matches_df is None:
+            latest_starts = pl.DataFrame(
+                schema={"sequencer_name": pl.String, "latest_start": pl.Float64}
+            )
+        else:
+            latest_starts = self._matches_df.group_by("sequencer_name").agg(
+                latest_start=pl.col("start_time").max()
+            )
+        return (
+            windows_df.join(latest_starts, on="sequencer_name", how="left")
+            .filter(
+                pl.col("stop_time") <= horizon,
+                (pl.col("start_time") < pl.col("latest_start")).fill_null(False)
+                | (pl.col("start_time") <= self._settled(final, horizon)),
+            )
+            .drop("latest_start")
+        )
+
+    def refresh(self, final: bool = False) -> pl.DataFrame:
+        """Read the new data and return the spill log rows of new final windows.
+
+        If `final` is true, all files are assumed to be complete, i.e. all
+        remaining windows are emitted.
+        """
+        new_sequencer_df = self._sequencer.read()
+        if new_sequencer_df.height > 0:
+            self._sequencer_df = pl.concat(
+                [self._sequencer_df, parse_sequencer(new_sequencer_df)]
+            )
+        chronobox_df = (
+            self._chronobox.read()
+            .filter(pl.col("leading_edge"))
+            .select("board", "channel", "chronobox_time")
+        )
+        self._chronobox_chunks.append(chronobox_df)
+        self._markers_df = pl.concat(
+            [
+                self._markers_df,
+                chronobox_df.join(
+                    self._marker_channels_df, on=["board", "channel"], how="semi"
+                ),
+            ]
+        )
+        self._trg_chunks.append(self._trg.read())
+
+        if final:
+            horizon = math.inf
+        else:
+            latest = self._chronobox_chunks.latest
+            # Without any TRG data (yet), only wait for the Chronobox.
+            if self._trg_chunks.latest > -math.inf:
+                latest = min(latest, self._trg_chunks.latest)
+            horizon = latest - SETTLE_TIME
+
+        events_df = self._events(final, self._settled(final, horizon))
+        # Without any dump markers yet, the window times would have a null type.
+        windows_df = (
+            dump_windows(events_df)
+            .cast(self._emitted_df.schema)
+            .join(self._emitted_df, on=_WINDOW_KEY, how="anti", join_nulls=True)
+        )
+        ready_df = self._ready_windows(windows_df, final, horizon)
+
+        spill_log_df = pl.DataFrame(
+            schema={
+                **ready_df.schema,
+                **{name: pl.Int64 for name in self.channel_names},
+                "trg_approx_input": pl.Int64,
+            }
+        )
+        if ready_df.height > 0:
+            t_min, t_max = ready_df["start_time"].min(), ready_df["stop_time"].max()
+            counts_df = chronobox_counts(
+                self._chronobox_chunks.overlapping(t_min, t_max),
+                self.channels_df,
+                ready_df,
+            )
+            spill_log_df = counts_df.select(
+                pl.col(ready_df.columns),
+                *(
+                    pl.col(name)
+                    if name in counts_df.columns
+                    else pl.lit(0, dtype=pl.Int64).alias(name)
+                    for name in self.channel_names
+                ),
+                trg_approx_input=trg_approx_input(
+                    self._trg_chunks.overlapping(t_min, t_max), ready_df
+                ),
+            ).sort("start_time", "stop_time")
+            self._emitted_df = pl.concat(
+                [self._emitted_df, ready_df.select(_WINDOW_KEY)]
+            )
+
+        # Drop the data that no window can need anymore. A window that is still
+        # missing starts either within the data that is still settling, at a
+        # known start time (a window that is not final yet), at a "startDump"
+        # of the latest iteration of its sequencer (its "stopDump" hasn't
+        # happened yet), or after the start of a sequence whose XML is not in
+        # the sequencer file yet. Nothing is known about the windows until the
+        # clock offset is found.
+        if self._shift is not None and not final:
+            open_starts = (
+                events_df.drop_nulls()
+                .sort("chronobox_time", maintain_order=True)
+                .with_columns(
+                    iteration=pl.col("event_name")
+                    .eq("seqRunning")
+                    .cum_sum()
+                    .over("sequencer_name")
+                )
+                .filter(
+                    pl.col("iteration")
+                    == pl.col("iteration").max().over("sequencer_name"),
+                    pl.col("event_name") == "startDump",
+                )
+                .select(
+                    "sequencer_name", "event_description", start_time="chronobox_time"
+                )
+                .join(
+                    self._emitted_df,
+                    on=["sequencer_name", "event_description", "start_time"],
+                    how="anti",
+                )["start_time"]
+            )
+            unknown_start = max(
+                self._sequencer_df["midas_timestamp"].max() - self._shift - TOLERANCE,
+                self._chronobox_chunks.latest - MAX_SEQUENCER_LAG,
+            )
+            keep_from = min(
+                [
+                    horizon,
+                    unknown_start,
+                    *windows_df.join(
+                        ready_df, on=_WINDOW_KEY, how="anti", join_nulls=True
+                    )["start_time"],
+                    *open_starts,
+                ]
+            )
+            self._chronobox_chunks.drop_before(keep_from)
+            self._trg_chunks.drop_before(keep_from)
+
+        # An iteration is finished once the next one of the same sequencer
+        # started before the horizon (all its windows were just emitted) and
+        # long enough ago that no XML can still show up in between. Drop its
+        # XML and markers so that it is not matched again on every refresh.
+        if self._matches_df is not None and not final:
+            cutoff = self._settled(final, horizon)
+            finished = (
+                self._matches_df.sort("start_time")
+                .with_columns(
+                    next_start=pl.col("start_time").shift(-1).over("sequencer_name")
+                )
+                .select(
+                    "sequencer_name",
+                    "midas_timestamp",
+                    finished=(pl.col("next_start") <= cutoff).fill_null(False),
+                )
+            )
+            if finished["finished"].any():
+                self._sequencer_df = self._sequencer_df.join(
+                    finished.filter("finished"),
+                    on=["sequencer_name", "midas_timestamp"],
+                    how="anti",
+                )
+                # The first unfinished start is still matched among all the
+                # "SEQ_RUNNING" hits within the tolerance of its XML.
+                first_start = self._matches_df.join(
+                    finished.filter(~pl.col("finished")),
+                    on=["sequencer_name", "midas_timestamp"],
+                    how="semi",
+                )["start_time"].min()
+                self._markers_df = self._markers_df.filter(
+                    pl.col("chronobox_time") >= first_start - 2 * TOLERANCE
+                )
+                self._emitted_df = self._emitted_df.filter(
+                    pl.col("start_time") >= first_start
+                )
+
+        return spill_log_df
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+import os
+
+# Unlike `utils.cache`, this module doesn't need Polars (it is also used to load
+# the ODB, see `odb.py`).
+
+
+class MemoryCache:
+    """In-memory cache of whole input files (e.g. parsed CSV files).
+
+    Entries are keyed by path and a `tag` (e.g. the schema it was parsed with),
+    and they are reloaded as soon as the size or modification time of the file
+    changes. The least recently used entries are evicted once the total
+    (estimated) size goes over `max_size` bytes.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, path: str, tag: str, load: Callable[[], Any]) -> Any:
+        """Return the cached `load()` of `path`, loading it if needed."""
+        key = (os.path.abspath(path), tag)
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self._entries.move_to_end(key)
+            return entry[2]
+        if entry is not None:
+            del self._entries[key]
+            self.size -= entry[1]
+
+        value = load()
+        # Parsed files are about as large as the files themselves (except for
+        # DataFrames, which know their own size).
+        if hasattr(value, "estimated_size"):
+            size = value.estimated_size()
+        else:
+            size = stat.st_size
+        self._entries[key] = (stamp, size, value)
+        self.size += size
+        # Even if a single entry is larger than the cache, keep it until the
+        # next one comes in.
+        while self.size > self.max_size and len(self._entries) > 1:
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self.size -= size
+        return value
+
+
+_memory_cache = None
+
+
+def set_memory_cache(cache: Optional[MemoryCache]):
+    """Keep the input files in memory (see `query_server.py`)."""
+    global _memory_cache
+    _memory_cache = cache
+
+
+def memory_cache() -> Optional[MemoryCache]:
+    """The `MemoryCache` in use (if any, see `set_memory_cache`)."""
+    return _memory_cache
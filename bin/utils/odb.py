@@ -0,0 +1,206 @@
+from jsonpointer import JsonPointer
+from typing import Any, Optional
+import functools
+import json
+import math
+import mmap
+import re
+from utils.memory import memory_cache
+
+
+# Everything up to the next bracket (skipping over complete strings, which may
+# contain brackets themselves). Strings are matched as runs of plain characters
+# between escapes; one character at a time is several times slower, and most of
+# the time skipping an ODB subtree is spent in here.
+_STRING_PATTERN = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_FILLER = re.compile(rb'(?:[^"\[\]{}]+|%s)*' % _STRING_PATTERN)
+_STRING = re.compile(_STRING_PATTERN)
+_SCALAR = re.compile(rb"[^\s,\]}]+")
+_WHITESPACE = re.compile(rb"\s*")
+
+
+def _pointer_tree(pointers: list[str]) -> Optional[dict]:
+    # Nested dictionary of all the reference tokens needed to resolve all the
+    # pointers. A `None` value means that the whole subtree is needed.
+    tree = {}
+    for pointer in pointers:
+        parts = JsonPointer(pointer).parts
+        if not parts:
+            return None
+        node = tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is None:
+                break
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def _is_wildcard(token: str) -> bool:
+    return "*" in token
+
+
+@functools.lru_cache(maxsize=None)
+def _wildcard_regex(token: str) -> re.Pattern:
+    return re.compile(".*".join(re.escape(part) for part in token.split("*")))
+
+
+def _token_matches(token: str, key: str) -> bool:
+    if _is_wildcard(token):
+        return _wildcard_regex(token).fullmatch(key) is not None
+    return token == key
+
+
+def _merge_trees(a: Optional[dict], b: Optional[dict]) -> Optional[dict]:
+    if a is None or b is None:
+        return None
+    merged = dict(a)
+    for token, subtree in b.items():
+        merged[token] = (
+            _merge_trees(merged[token], subtree) if token in merged else subtree
+        )
+    return merged
+
+
+def _subtree(tree: dict, key: str) -> tuple[bool, Optional[dict]]:
+    # Return whether `key` is needed at all, and the merged subtree of all the
+    # (possibly wildcard) tokens that match it.
+    if not any(_is_wildcard(token) for token in tree):
+        return key in tree, tree.get(key)
+
+    matches = [subtree for token, subtree in tree.items() if _token_matches(token, key)]
+    if not matches:
+        return False, None
+    return True, functools.reduce(_merge_trees, matches)
+
+
+def _num_leaves(tree: Optional[dict]) -> float:
+    # With wildcards we can't know in advance how many subtrees will match.
+    if tree is None:
+        return 1
+    elif any(_is_wildcard(token) for token in tree):
+        return math.inf
+    return sum(_num_leaves(subtree) for subtree in tree.values())
+
+
+class _SubtreeParser:
+    def __init__(self, buf, tree: dict):
+        self.buf = buf
+        self.remaining = _num_leaves(tree)
+
+    def skip_whitespace(self, pos: int) -> int:
+        return _WHITESPACE.match(self.buf, pos).end()
+
+    def skip_value(self, pos: int) -> int:
+        c = self.buf[pos : pos + 1]
+        if c == b'"':
+            return _STRING.match(self.buf, pos).end()
+        elif c not in (b"{", b"["):
+            return _SCALAR.match(self.buf, pos).end()
+
+        depth = 0
+        while True:
+            c = self.buf[pos : pos + 1]
+            if c in (b"{", b"["):
+                depth += 1
+            elif c in (b"}", b"]"):
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+            elif c == b"":
+                raise ValueError("unexpected end of JSON")
+            pos = _FILLER.match(self.buf, pos + 1).end()
+
+    def parse(self, pos: int, tree: Optional[dict]):
+        """Parse the value at `pos`, keeping only the members in `tree`.
+
+        Returns the (pruned) value and the position right after it. The position
+        is `None` if parsing stopped early because all the requested subtrees
+        were already found.
+        """
+        pos = self.skip_whitespace(pos)
+        if tree is None or self.buf[pos : pos + 1] != b"{":
+            end = self.skip_value(pos)
+            if self.remaining < math.inf:
+                self.remaining -= _num_leaves(tree)
+            return json.loads(self.buf[pos:end]), end
+
+        result = {}
+        pos = self.skip_whitespace(pos + 1)
+        while self.buf[pos : pos + 1] != b"}":
+            match = _STRING.match(self.buf, pos)
+            if match is None:
+                raise ValueError(f"expected object key at byte {pos}")
+            key = json.loads(match.group())
+            pos = self.skip_whitespace(match.end())
+            if self.buf[pos : pos + 1] != b":":
+                raise ValueError(f"expected `:` at byte {pos}")
+            pos = self.skip_whitespace(pos + 1)
+
+            needed, subtree = _subtree(tree, key)
+            if needed:
+                result[key], pos = self.parse(pos, subtree)
+                if self.remaining == 0:
+                    return result, None
+            else:
+                pos = self.skip_value(pos)
+
+            pos = self.skip_whitespace(pos)
+            if self.buf[pos : pos + 1] == b",":
+                pos = self.skip_whitespace(pos + 1)
+        return result, pos + 1
+
+
+def load_odb(path: str, pointers: Optional[list[str]] = None) -> dict:
+    """Load an ODB JSON file.
+
+    If `pointers` is given, only the subtrees needed to resolve these JSON
+    pointers are parsed; everything else is skipped without being decoded.
+    Pointers can use `*` wildcards within reference tokens (see
+    `resolve_wildcard_pointer`).
+
+    If the input files are kept in memory (see `utils.memory.MemoryCache`), the
+    whole ODB is parsed once instead (a superset of the requested subtrees).
+    """
+    cache = memory_cache()
+    if cache is not None:
+        return cache.get(path, "odb", lambda: _load_odb(path, None))
+    return _load_odb(path, pointers)
+
+
+def _load_odb(path: str, pointers: Optional[list[str]]) -> dict:
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            # First 2 lines are comments
+            start = buf.find(b"\n", buf.find(b"\n") + 1) + 1
+
+            tree = None if pointers is None else _pointer_tree(pointers)
+            if tree is None:
+                return json.loads(buf[start:])
+            return _SubtreeParser(buf, tree).parse(start, tree)[0]
+
+
+def resolve_wildcard_pointer(odb: dict, pointer: str) -> list[tuple[str, Any]]:
+    """Resolve a JSON pointer that can have `*` wildcards in its reference tokens.
+
+    A `*` matches any sequence of characters within a single reference token
+    (e.g. `/Equipment/cb*/Settings/names`). Returns the (pointer, value) pairs of
+    all matches.
+    """
+    matches = [([], odb)]
+    for token in JsonPointer(pointer).parts:
+        next_matches = []
+        for parts, value in matches:
+            if isinstance(value, dict):
+                items = value.items()
+            elif isinstance(value, list):
+                items = ((str(i), v) for i, v in enumerate(value))
+            else:
+                continue
+            next_matches.extend(
+                (parts + [key], v) for key, v in items if _token_matches(token, key)
+            )
+        matches = next_matches
+
+    return [(JsonPointer.from_parts(parts).path, value) for parts, value in matches]
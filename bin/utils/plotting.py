@@ -0,0 +1,35 @@
+# Set by the query server (see `query_server.py`), which has no display.
+_headless = False
+
+
+def set_headless():
+    """Only allow plots to be written to files (see `import_pyplot`)."""
+    global _headless
+    _headless = True
+
+
+def check_display(parser, interactive: bool):
+    """Exit with a usage error if the plot can't be shown (see `set_headless`).
+
+    Call this right after parsing the arguments, before reading any data.
+    """
+    if interactive and _headless:
+        parser.error("plots can only be written to a file (e.g. --output)")
+
+
+def import_pyplot(interactive: bool):
+    """Import `matplotlib.pyplot` (only once it is actually needed).
+
+    Without `interactive` (i.e. figures are only saved to files), the
+    non-interactive Agg backend is selected before `pyplot` is loaded, which
+    skips initializing a GUI toolkit altogether.
+    """
+    if interactive and _headless:
+        raise RuntimeError("plots can only be written to a file (e.g. --output)")
+    import matplotlib
+
+    if not interactive:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
@@ -0,0 +1,39 @@
+from typing import Optional
+import json
+import os
+import socket
+import tempfile
+
+# Scripts that can be run by the query server (see `query_server.py`).
+QUERY_SCRIPTS = ["chronobox_timestamps.py", "odb.py", "trg_scalers.py", "vertices.py"]
+
+
+def default_socket() -> str:
+    return os.environ.get(
+        "ALPHA_G_QUERY_SOCKET",
+        os.path.join(tempfile.gettempdir(), f"alpha-g-query-{os.getuid()}.sock"),
+    )
+
+
+def add_socket_argument(parser):
+    parser.add_argument(
+        "--socket",
+        default=default_socket(),
+        help="path to the Unix socket of the query server "
+        "(can also be set with the ALPHA_G_QUERY_SOCKET environment variable)",
+    )
+
+
+def send_message(sock: socket.socket, message: dict):
+    sock.sendall(json.dumps(message).encode() + b"\n")
+
+
+def receive_message(sock: socket.socket) -> Optional[dict]:
+    """Receive a single message (`None` if the connection was closed)."""
+    chunks = []
+    while not chunks or not chunks[-1].endswith(b"\n"):
+        chunk = sock.recv(1 << 16)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+    return json.loads(b"".join(chunks))
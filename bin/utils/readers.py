@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterator, Optional
+import csv
+import gzip
+import polars as pl
+from utils.memory import memory_cache
+
+# Size of the decompressed blocks handed to the CSV parser.
+_BLOCK_SIZE = 1 << 24
+
+
+def _parse_schema(schema: dict) -> dict:
+    # The CSV reader can't parse enums directly. Read them as strings and cast
+    # them afterwards.
+    return {
+        name: pl.String if isinstance(dtype, pl.Enum) else dtype
+        for name, dtype in schema.items()
+    }
+
+
+def is_compressed(path: str) -> bool:
+    return path.endswith((".gz", ".zst", ".lz4"))
+
+
+def _open_compressed(path: str) -> BinaryIO:
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    # These are not in the requirements (most people don't need them), so only
+    # import them when they are actually needed.
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("reading `.zst` files requires `zstandard`") from None
+        return zstandard.open(path, "rb")
+    if path.endswith(".lz4"):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError("reading `.lz4` files requires `lz4`") from None
+        return lz4.frame.open(path, "rb")
+    raise ValueError(f"unknown compression format `{path}`")
+
+
+def _record_end(data: bytes) -> int:
+    # Position right after the last complete record, i.e. the last newline
+    # that is not inside a quoted field (an even number of quotes before it).
+    end = data.rfind(b"\n")
+    while end >= 0 and data.count(b'"', 0, end) % 2 != 0:
+        end = data.rfind(b"\n", 0, end)
+    return end + 1
+
+
+def _skip_header(block: bytes) -> tuple[int, bool]:
+    # Number of leading bytes that are comments or the header line, and whether
+    # the header line is still missing (i.e. it must be in a later block).
+    skipped = 0
+    while skipped < len(block):
+        is_comment = block.startswith(b"#", skipped)
+        skipped = block.find(b"\n", skipped) + 1 or len(block)
+        if not is_comment:
+            return skipped, False
+    return skipped, True
+
+
+def _header(f: BinaryIO) -> Optional[list[str]]:
+    for line in f:
+        if not line.startswith(b"#"):
+            return next(csv.reader([line.decode().rstrip("\r\n")]))
+    return None
+
+
+def check_header(path: str, schema: dict):
+    """Make sure that the header of a CSV file matches `schema` (see `scan_csv`).
+
+    The columns are parsed by position, so any mismatch would silently read the
+    wrong data. A file without a header (e.g. empty) is fine.
+    """
+    with _open_compressed(path) if is_compressed(path) else open(path, "rb") as f:
+        header = _header(f)
+    if header is not None and header != list(schema):
+        raise ValueError(
+            f"`{path}` has columns {header}, expected {list(schema)} (in this order)"
+        )
+
+
+def iter_data_blocks(f: BinaryIO, block_size: int) -> Iterator[tuple[int, bytes]]:
+    """Read a CSV file in blocks of complete records.
+
+    Yields `(offset, block)` where `offset` is the position of `block` within
+    the (decompressed) file. The leading comments and header line are skipped.
+    """
+    # Read the next block in a background thread while the current one is
+    # being parsed. Both zlib and the CSV parser release the GIL, so they do
+    # run in parallel (and a compressed file never lands on disk decompressed).
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(f.read, block_size)
+        offset = 0
+        rest = b""
+        skip_header = True
+        while rest or future is not None:
+            data = b"" if future is None else future.result()
+            if data:
+                future = executor.submit(f.read, block_size)
+                data = rest + data
+                end = _record_end(data)
+                block, rest = data[:end], data[end:]
+            else:
+                # End of file (the last record may be missing its newline).
+                future = None
+                block, rest = rest, b""
+
+            start = offset
+            offset += len(block)
+            # The comments and header line may end up in different blocks.
+            if skip_header:
+                skipped, skip_header = _skip_header(block)
+                block = block[skipped:]
+                start += skipped
+            if block:
+                yield start, block
+
+
+def parse_block(
+    block: bytes, schema: dict, columns: Optional[list[str]] = None
+) -> pl.DataFrame:
+    """Parse a block of CSV records (without a header, see `iter_data_blocks`).
+
+    See `scan_csv` for the `schema`; only the given `columns` are parsed (all
+    by default).
+    """
+    # Without a header, the parser only knows the columns by position.
+    indices = None if columns is None else [list(schema).index(c) for c in columns]
+    return pl.read_csv(
+        block, has_header=False, schema=_parse_schema(schema), columns=indices
+    ).cast({name: schema[name] for name in columns or schema})
+
+
+def _iter_compressed_csv(
+    path: str,
+    schema: dict,
+    columns: Optional[list[str]],
+    predicate: Optional[pl.Expr] = None,
+) -> Iterator[pl.DataFrame]:
+    parsed = columns
+    if predicate is not None and columns is not None:
+        parsed = list(dict.fromkeys([*columns, *predicate.meta.root_names()]))
+    with _open_compressed(path) as f:
+        for _, block in iter_data_blocks(f, _BLOCK_SIZE):
+            df = parse_block(block, schema, parsed)
+            if predicate is not None:
+                df = df.filter(predicate)
+            yield df.select(columns or list(schema))
+
+
+def _select(
+    lf: pl.LazyFrame, columns: Optional[list[str]], predicate: Optional[pl.Expr]
+) -> pl.LazyFrame:
+    if predicate is not None:
+        lf = lf.filter(predicate)
+    return lf if columns is None else lf.select(columns)
+
+
+def scan_csv(
+    path: str,
+    schema: dict,
+    columns: Optional[list[str]] = None,
+    predicate: Optional[pl.Expr] = None,
+) -> pl.LazyFrame:
+    """Lazily read a CSV file with one of the schemas in `utils.schemas`.
+
+    The schema is used as is (no type inference), and an empty file is just an
+    empty frame. Only the given `columns` (all by default) of the rows that
+    match `predicate` (all by default) are returned. Compressed files (`.gz`,
+    `.zst`, `.lz4`) are decompressed on the fly; Polars can't push a query down
+    into them, so pass the `columns` and `predicate` here instead of
+    filtering/selecting the result, and they are applied to every block as
+    soon as it is parsed.
+    """
+    cache = memory_cache()
+    if cache is not None:
+        df = cache.get(path, f"csv {schema}", lambda: _scan_csv(path, schema).collect())
+        return _select(df.lazy(), columns, predicate)
+    return _scan_csv(path, schema, columns, predicate)
+
+
+def _scan_csv(
+    path: str,
+    schema: dict,
+    columns: Optional[list[str]] = None,
+    predicate: Optional[pl.Expr] = None,
+) -> pl.LazyFrame:
+    check_header(path, schema)
+    if is_compressed(path):
+        return pl.concat(
+            [pl.DataFrame(schema={name: schema[name] for name in columns or schema})]
+            + list(_iter_compressed_csv(path, schema, columns, predicate))
+        ).lazy()
+
+    lf = pl.scan_csv(
+        path, comment_prefix="#", schema=_parse_schema(schema), raise_if_empty=False
+    ).cast(schema)
+    return _select(lf, columns, predicate)
+
+
+def read_csv(
+    path: str,
+    schema: dict,
+    columns: Optional[list[str]] = None,
+    predicate: Optional[pl.Expr] = None,
+) -> pl.DataFrame:
+    """Same as `scan_csv`, but eager."""
+    return scan_csv(path, schema, columns, predicate).collect()
+
+
+def iter_csv_batches(
+    path: str, chunk_size: int, schema: dict, columns: Optional[list[str]] = None
+) -> Iterator[pl.DataFrame]:
+    """Read a CSV file in DataFrames of (approximately) `chunk_size` rows.
+
+    Only a single chunk is held in memory at any time. See `scan_csv` for the
+    `schema`; only the given `columns` are parsed (all by default).
+    """
+    check_header(path, schema)
+    if is_compressed(path):
+        for block in _iter_compressed_csv(path, schema, columns):
+            yield from block.iter_slices(chunk_size)
+        return
+
+    reader = pl.read_csv_batched(
+        path,
+        batch_size=chunk_size,
+        comment_prefix="#",
+        schema_overrides=_parse_schema(schema),
+        columns=columns,
+    )
+    while True:
+        batches = reader.next_batches(1)
+        if batches is None:
+            return
+        yield batches[0].cast({name: schema[name] for name in batches[0].columns})
+
+
+class CsvFollower:
+    """Read the records appended to a (growing) CSV file since the last read.
+
+    Only complete records are read; a partially written last line is left for
+    the next read. The file doesn't need to exist yet.
+    """
+
+    def __init__(self, path: str, schema: dict, columns: Optional[list[str]] = None):
+        self.path = path
+        self.schema = schema
+        self.columns = columns
+        self.offset = 0
+        self._skip_header = True
+
+    def read(self) -> pl.DataFrame:
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        data = data[: _record_end(data)]
+        self.offset += len(data)
+
+        if self._skip_header:
+            skipped, self._skip_header = _skip_header(data)
+            if not self._skip_header:
+                check_header(self.path, self.schema)
+            data = data[skipped:]
+        if not data:
+            return pl.DataFrame(
+                schema={name: self.schema[name] for name in self.columns or self.schema}
+            )
+        return parse_block(data, self.schema, self.columns)
@@ -0,0 +1,56 @@
+import polars as pl
+from utils.constants import KNOWN_CHRONOBOXES
+
+# Explicit schemas for all the CSV files we read. This skips type inference
+# (an extra pass over the file), and keeps the in-memory frames small.
+BOARD = pl.Enum(KNOWN_CHRONOBOXES)
+CHANNEL = pl.UInt8
+
+CHRONOBOX_SCHEMA = {
+    "board": BOARD,
+    "channel": CHANNEL,
+    "leading_edge": pl.Boolean,
+    "chronobox_time": pl.Float64,
+}
+# Output of the `alpha-g-sequencer` core binary.
+SEQUENCER_SCHEMA = {
+    "midas_timestamp": pl.Int64,
+    "xml": pl.String,
+}
+# Output of `sequencer.py` (not in pretty mode).
+SEQUENCER_EVENTS_SCHEMA = {
+    "sequencer_name": pl.String,
+    "event_name": pl.String,
+    "event_description": pl.String,
+    "chronobox_time": pl.Float64,
+}
+# The schema is also necessary because this CSV can be empty (and that should
+# still be a valid spill log, just with TRG counters set to 0).
+TRG_SCALERS_SCHEMA = {
+    "serial_number": pl.UInt32,
+    "trg_time": pl.Float64,
+    "input": pl.Int64,
+    "drift_veto": pl.Int64,
+    "scaledown": pl.Int64,
+    "pulser": pl.Int64,
+    "output": pl.Int64,
+}
+# Vertex resolution is a few mm, so single precision coordinates are plenty.
+# Times need double precision (runs are hours long and we care about us).
+VERTICES_SCHEMA = {
+    "run_number": pl.UInt32,
+    "serial_number": pl.UInt32,
+    "trg_time": pl.Float64,
+    "reconstructed_x": pl.Float32,
+    "reconstructed_y": pl.Float32,
+    "reconstructed_z": pl.Float32,
+}
+# Input of `spill_log_batch.py` (one row per run). Relative paths are relative
+# to the manifest itself.
+SPILL_LOG_MANIFEST_SCHEMA = {
+    "run_number": pl.UInt32,
+    "sequencer_events_csv": pl.String,
+    "odb_json": pl.String,
+    "chronobox_csv": pl.String,
+    "trg_scalers_csv": pl.String,
+}
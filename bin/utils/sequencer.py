@@ -0,0 +1,453 @@
+from typing import NamedTuple, Optional
+import functools
+import math
+import numpy as np
+import polars as pl
+import sys
+import xml.etree.ElementTree as ET
+from utils.readers import read_csv
+from utils.schemas import SEQUENCER_SCHEMA
+
+# The XML timestamps are only good to within a few seconds.
+TOLERANCE = 5.0
+
+
+class SequencerEvent(NamedTuple):
+    name: str
+    description: str
+
+
+class SequencerXml(NamedTuple):
+    sequencer_name: str
+    event_table: list[SequencerEvent]
+
+
+class ClockMatch(NamedTuple):
+    # MIDAS timestamp minus Chronobox time.
+    shift: float
+    # Fraction of the XMLs with a single "SEQ_RUNNING" hit within the tolerance.
+    confidence: float
+    # One sequencer_name,midas_timestamp,start_time,residual,candidates row per
+    # XML. The residual is the shifted XML timestamp minus its matched hit, and
+    # candidates is the number of hits within the tolerance.
+    matches: pl.DataFrame
+
+
+# The same sequence XML is usually repeated for hundreds of iterations in a
+# single run. Memoize the parsed result so that each distinct XML is parsed
+# only once.
+@functools.lru_cache(maxsize=256)
+def parse_xml(xml_string: str) -> SequencerXml:
+    root = ET.fromstring(xml_string)
+    # Setting default to "" allows us to handle missing elements and missing
+    # text the same way.
+    sequencer_name = root.findtext("SequencerName", default="")
+    if sequencer_name == "":
+        raise ValueError("error finding sequencer name in XML")
+
+    events = []
+    for event in root.iter("event"):
+        name = event.findtext("name", default="")
+        description = event.findtext("description", default="")
+        if name == "" or description == "":
+            raise ValueError("error finding event table in XML")
+        else:
+            # https://github.com/pola-rs/polars/issues/15425
+            events.append(SequencerEvent(name, description)._asdict())
+
+    # https://github.com/pola-rs/polars/issues/15425
+    return SequencerXml(sequencer_name, events)._asdict()
+
+
+def pair_counts(
+    channels: list[tuple[np.ndarray, np.ndarray]], tolerance: float
+) -> tuple[float, np.ndarray]:
+    """Count the (MIDAS timestamp, Chronobox time) pairs around every offset.
+
+    Each element of `channels` holds the MIDAS timestamps of the sequencer XMLs
+    and the Chronobox times of the "SEQ_RUNNING" hits for a single channel.
+    Returns `(first, counts)` such that `counts[i]` is at least the number of
+    pairs whose `midas_timestamp - chronobox_time` is within `tolerance` of the
+    offset `first + i`. All offsets are computed at once from the
+    cross-correlation of both histograms (1 s bins) instead of trying every
+    pair.
+    """
+    channels = [(m, c) for m, c in channels if m.size > 0 and c.size > 0]
+    if not channels:
+        return 0.0, np.zeros(0)
+    m_min = min(np.floor(m.min()) for m, _ in channels)
+    c_min = min(np.floor(c.min()) for _, c in channels)
+    m_len = int(max(m.max() for m, _ in channels) - m_min) + 1
+    c_len = int(max(c.max() for _, c in channels) - c_min) + 1
+    n = m_len + c_len - 1
+
+    correlation = np.zeros(n)
+    for m, c in channels:
+        m_hist = np.bincount((m - m_min).astype(np.int64), minlength=m_len)
+        c_hist = np.bincount((c - c_min).astype(np.int64), minlength=c_len)
+        correlation += np.fft.irfft(
+            np.fft.rfft(m_hist, n) * np.fft.rfft(c_hist[::-1], n), n
+        )
+    # The binned difference of a pair is within 1 s of the actual one, and the
+    # offset is rounded to a bin. Widen the window enough to never miss a pair.
+    width = 2 * (math.ceil(tolerance) + 1) + 1
+    correlation = np.convolve(np.rint(correlation), np.ones(width), mode="same")
+
+    return float(m_min - c_min - (c_len - 1)), correlation
+
+
+def read_sequencer_csv(path: str) -> pl.DataFrame:
+    """Read a sequencer CSV file (produced by the `alpha-g-sequencer` core binary).
+
+    Returns a midas_timestamp,sequencer_name,event_table DataFrame with the
+    parsed XML of every row.
+    """
+    return parse_sequencer(read_csv(path, SEQUENCER_SCHEMA))
+
+
+def parse_sequencer(df: pl.DataFrame) -> pl.DataFrame:
+    """Same as `read_sequencer_csv`, but from an already read DataFrame."""
+    return df.select(
+        "midas_timestamp",
+        parsed=pl.col("xml").map_elements(
+            parse_xml,
+            return_dtype=pl.Struct(
+                {
+                    "sequencer_name": pl.String,
+                    "event_table": pl.List(
+                        pl.Struct({"name": pl.String, "description": pl.String})
+                    ),
+                }
+            ),
+        ),
+    ).unnest("parsed")
+
+
+def sequencer_events(
+    sequencer_df: pl.DataFrame, chronobox_df: pl.DataFrame, channels_df: pl.DataFrame
+) -> pl.DataFrame:
+    """Find the Chronobox timestamp of all sequencer events.
+
+    `sequencer_df` is the output of `read_sequencer_csv`, `chronobox_df` has all
+    the board,channel,chronobox_time leading edges, and `channels_df` is the ODB
+    lookup table from `chronobox_channels`. Returns a
+    sequencer_name,event_name,event_description,chronobox_time DataFrame.
+    """
+    return sequencer_events_with_offset(sequencer_df, chronobox_df, channels_df)[0]
+
+
+def sequencer_events_with_offset(
+    sequencer_df: pl.DataFrame,
+    chronobox_df: pl.DataFrame,
+    channels_df: pl.DataFrame,
+    shift: Optional[float] = None,
+    warn: bool = True,
+) -> tuple[pl.DataFrame, ClockMatch]:
+    """Same as `sequencer_events`, but also return how the XMLs were matched.
+
+    The clock offset (MIDAS minus Chronobox time) is searched from scratch
+    unless an initial `shift` is given (e.g. from a previous call with the same
+    run) and it still gives a complete and unique match. If `warn` is false,
+    mismatched dump markers are left to the caller (see
+    `warn_mismatched_markers`).
+    """
+    # The sequencer XMLs are reliable to let us know if a sequence started
+    # running, but its timestamp is only good to within a few seconds. On the
+    # other hand, the Chronobox timestamps are good, but it has some noise/false
+    # positives (we detect leading edges, and it looks like the sequencer can't
+    # always keep the "SEQ_RUNNING" signal high, so it falls and rises again
+    # every now and then).
+    # Hence we need to match the sequencer XMLs to the Chronobox "SEQ_RUNNING"
+    # timestamps (filtering out false positives).
+    # Every sequencer has its own "_SEQ_RUNNING", "_START_DUMP", and
+    # "_STOP_DUMP" Chronobox channels. Resolve them once per sequencer name and
+    # attach them to all iterations with a single join.
+    sequencer_channels_df = sequencer_df.select(pl.col("sequencer_name").unique())
+    for suffix, channel_name in [
+        ("_running", "_SEQ_RUNNING"),
+        ("_start", "_START_DUMP"),
+        ("_stop", "_STOP_DUMP"),
+    ]:
+        sequencer_channels_df = sequencer_channels_df.with_columns(
+            channel_name=pl.col("sequencer_name").str.to_uppercase() + channel_name
+        ).join(
+            channels_df.rename(
+                {"board": "board" + suffix, "channel": "channel" + suffix}
+            ),
+            on="channel_name",
+            how="left",
+        )
+        duplicates = sequencer_channels_df.filter(pl.col("duplicate"))
+        if duplicates.height > 0:
+            raise ValueError(
+                f"multiple `{duplicates['channel_name'][0]}` channels in ODB"
+            )
+        sequencer_channels_df = sequencer_channels_df.drop("channel_name", "duplicate")
+
+    sequencer_df = sequencer_df.join(
+        sequencer_channels_df, on="sequencer_name", how="left"
+    )
+    # Some times people randomly run A2 sequencers (e.g. atm, rct, etc) to do
+    # stuff like a random MCP dump. These sequencer signals are usually not
+    # connected to the Chronoboxes, so instead of crashing, we just ignore them.
+    # This doesn't affect at all the other sequences.
+    for (name,) in (
+        sequencer_df.filter(pl.any_horizontal(pl.all().is_null()))
+        .select("sequencer_name")
+        .unique()
+        .rows()
+    ):
+        print(
+            f"Ignoring `{name}` sequencer (chronobox channels not found in ODB).",
+            file=sys.stderr,
+        )
+    sequencer_df = sequencer_df.drop_nulls()
+
+    cb_running_df = chronobox_df.join(
+        sequencer_df,
+        left_on=["board", "channel"],
+        right_on=["board_running", "channel_running"],
+        how="semi",
+    )
+
+    def match_seq_running(shift: float) -> pl.DataFrame:
+        return (
+            sequencer_df.with_columns(
+                shifted_timestamp=pl.col("midas_timestamp") - shift
+            )
+            .sort("shifted_timestamp")
+            .join_asof(
+                cb_running_df.sort("chronobox_time"),
+                left_on="shifted_timestamp",
+                right_on="chronobox_time",
+                by_left=["board_running", "channel_running"],
+                by_right=["board", "channel"],
+                strategy="nearest",
+                tolerance=TOLERANCE,
+            )
+            .rename({"chronobox_time": "start_time"})
+            .with_columns(residual=pl.col("shifted_timestamp") - pl.col("start_time"))
+        )
+
+    def is_complete(temp: pl.DataFrame) -> bool:
+        return temp.height > 0 and temp["start_time"].null_count() == 0
+
+    def is_unique(temp: pl.DataFrame) -> bool:
+        # Two XMLs matched to the same hit means that (at least) one of them
+        # took a false positive instead of its own "SEQ_RUNNING" hit.
+        return (
+            temp.select("board_running", "channel_running", "start_time").n_unique()
+            == temp.height
+        )
+
+    # Every sensible offset matches the first XML to one of the "SEQ_RUNNING"
+    # hits in its channel. These are tried in Chronobox order, i.e. the earliest
+    # hit (and hence the true rising edge instead of a false positive) first,
+    # and the first one that gives a complete and unique match is taken.
+    candidates = (
+        sequencer_df.head(1)
+        .join(
+            cb_running_df,
+            left_on=["board_running", "channel_running"],
+            right_on=["board", "channel"],
+        )
+        .select(pl.col("midas_timestamp") - pl.col("chronobox_time").round())
+        .to_series()
+        .to_list()
+    )
+
+    temp = None
+    if shift is not None:
+        temp = match_seq_running(shift)
+        if not (is_complete(temp) and is_unique(temp)):
+            temp = None
+    if temp is None:
+        first, counts = pair_counts(
+            [
+                (
+                    group["midas_timestamp"].to_numpy(),
+                    cb_running_df.filter(
+                        pl.col("board") == board, pl.col("channel") == channel
+                    )["chronobox_time"].to_numpy(),
+                )
+                for (board, channel), group in sequencer_df.group_by(
+                    "board_running", "channel_running"
+                )
+            ],
+            TOLERANCE,
+        )
+
+        def count(shift: float) -> float:
+            i = round(shift - first)
+            return counts[i] if 0 <= i < counts.size else 0.0
+
+        # A complete match needs (at least) one pair per XML. This skips most
+        # candidates without matching, and never a complete one.
+        candidates = [c for c in candidates if count(c) >= sequencer_df.height]
+        for shift in candidates:
+            temp = match_seq_running(shift)
+            if is_complete(temp) and is_unique(temp):
+                break
+        else:
+            # Fall back to the first candidate that matches all XMLs, even if
+            # some of them share a hit.
+            for shift in candidates:
+                temp = match_seq_running(shift)
+                if is_complete(temp):
+                    break
+            else:
+                # This failure means that we couldn't match all sequencer XMLs
+                # to a "SEQ_RUNNING" hit in a Chronobox. To debug this, the
+                # easiest would be to print the `match_seq_running(best)`
+                # DataFrame and look at the `residual` column (difference
+                # between the shifted XML timestamp and the matched Chronobox
+                # timestamp). The most likely causes are:
+                # 1. The tolerance is too low. Just increase it. This is
+                #    expected, the XML timestamps are not very accurate.
+                # 2. The "SEQ_RUNNING" hit for an XML is missing in the
+                #    Chronobox data. Find out why and fix it. Maybe the cable is
+                #    not connected. To fix this for a run that has already been
+                #    taken, just add a fake Chronobox hit in the
+                #    `chronobox_timestamps.csv` file by hand.
+                if counts.size == 0:
+                    raise ValueError("failed to match `SEQ_RUNNING` signals")
+                best = first + float(np.argmax(counts))
+                unmatched = match_seq_running(best)["start_time"].null_count()
+                raise ValueError(
+                    f"failed to match `SEQ_RUNNING` signals ({unmatched} of "
+                    f"{sequencer_df.height} unmatched with a clock offset of "
+                    f"{best:.3f} s)"
+                )
+
+    # The number of "SEQ_RUNNING" hits within the tolerance of each XML. A match
+    # is ambiguous if there is more than one.
+    hits = {
+        key: np.sort(group["chronobox_time"].to_numpy())
+        for key, group in cb_running_df.group_by("board", "channel")
+    }
+    temp = pl.concat(
+        [
+            group.with_columns(
+                candidates=pl.Series(
+                    np.searchsorted(
+                        hits[key],
+                        group["shifted_timestamp"].to_numpy() + TOLERANCE,
+                        "right",
+                    )
+                    - np.searchsorted(
+                        hits[key],
+                        group["shifted_timestamp"].to_numpy() - TOLERANCE,
+                        "left",
+                    ),
+                    dtype=pl.UInt32,
+                )
+            )
+            for key, group in temp.group_by("board_running", "channel_running")
+        ]
+    ).sort("shifted_timestamp")
+    matches_df = temp.select(
+        "sequencer_name", "midas_timestamp", "start_time", "residual", "candidates"
+    )
+    match = ClockMatch(
+        shift=shift,
+        confidence=matches_df["candidates"].eq(1).mean(),
+        matches=matches_df,
+    )
+    sequencer_df = temp.drop("shifted_timestamp", "residual", "candidates")
+
+    def dump_markers(board: str, channel: str) -> pl.DataFrame:
+        # Assign each dump marker hit to the last iteration of its sequencer
+        # that started at or before it, i.e. the iteration such that
+        # `start_time <= chronobox_time < next_start_time`.
+        return (
+            chronobox_df.join(
+                sequencer_df.select("sequencer_name", board, channel).unique(),
+                left_on=["board", "channel"],
+                right_on=[board, channel],
+                how="inner",
+            )
+            .sort("chronobox_time")
+            .join_asof(
+                sequencer_df.select("sequencer_name", "start_time").sort("start_time"),
+                left_on="chronobox_time",
+                right_on="start_time",
+                by="sequencer_name",
+                strategy="backward",
+            )
+            .drop_nulls("start_time")
+        )
+
+    expected_df = (
+        sequencer_df.explode("event_table")
+        .unnest("event_table")
+        .select(
+            "sequencer_name",
+            "start_time",
+            event_name="name",
+            event_description=pl.col("description").str.strip_chars('"'),
+            index=pl.int_range(pl.len()).over("sequencer_name", "start_time"),
+        )
+    )
+
+    observed_df = (
+        pl.concat(
+            [
+                dump_markers("board_start", "channel_start").with_columns(
+                    event_name=pl.lit("startDump")
+                ),
+                dump_markers("board_stop", "channel_stop").with_columns(
+                    event_name=pl.lit("stopDump")
+                ),
+            ]
+        )
+        .select(
+            "sequencer_name",
+            "start_time",
+            "event_name",
+            "chronobox_time",
+        )
+        .sort("chronobox_time", maintain_order=True)
+        .with_columns(index=pl.int_range(pl.len()).over("sequencer_name", "start_time"))
+    )
+
+    result = pl.concat(
+        [
+            sequencer_df.select(
+                "sequencer_name",
+                event_name=pl.lit("seqRunning"),
+                event_description=pl.lit("Sequence Started"),
+                chronobox_time="start_time",
+            ),
+            observed_df.join(
+                expected_df,
+                on=["sequencer_name", "start_time", "event_name", "index"],
+                how="left",
+            )
+            .with_columns(
+                pl.when(pl.col("event_description").is_null().cum_sum() == 0)
+                .then("event_description")
+                .over("sequencer_name", "start_time")
+            )
+            .select(
+                "sequencer_name", "event_name", "event_description", "chronobox_time"
+            ),
+        ]
+    ).sort("chronobox_time", maintain_order=True)
+    if warn:
+        warn_mismatched_markers(result)
+
+    return result, match
+
+
+def warn_mismatched_markers(events_df: pl.DataFrame):
+    """Warn about every sequencer with dump markers that are not in its XML."""
+    for (name,) in (
+        events_df.filter(pl.col("event_description").is_null())
+        .select("sequencer_name")
+        .unique()
+        .rows()
+    ):
+        print(
+            f"Warning: mismatched dump markers for `{name}` sequencer.",
+            file=sys.stderr,
+        )
@@ -0,0 +1,224 @@
+from typing import Iterable, Optional, TypeVar
+import numpy as np
+import polars as pl
+from utils.cache import ResultCache
+from utils.chronobox import (
+    CHRONOBOX_CHANNELS_POINTERS,
+    chronobox_channels,
+    iter_leading_edges,
+    scan_leading_edges,
+)
+from utils.odb import load_odb
+from utils.readers import iter_csv_batches, scan_csv
+from utils.schemas import SEQUENCER_EVENTS_SCHEMA, TRG_SCALERS_SCHEMA
+
+# Only these TRG columns are needed for the spill log.
+TRG_SCALERS_COLUMNS = ["trg_time", "input"]
+
+FrameType = TypeVar("FrameType", pl.DataFrame, pl.LazyFrame)
+
+
+def dump_windows(events_df: FrameType) -> FrameType:
+    """Pair up the dump markers from the sequencer events (see `sequencer_events`).
+
+    Returns a sequencer_name,event_description,start_time,stop_time DataFrame
+    with one row per dump window (or a LazyFrame if given a LazyFrame).
+    """
+    return (
+        events_df.drop_nulls()
+        .sort("chronobox_time", maintain_order=True)
+        .with_columns(
+            iteration=pl.col("event_name")
+            .eq("seqRunning")
+            .cum_sum()
+            .over("sequencer_name")
+        )
+        .filter(
+            pl.col("event_name").eq("startDump") | pl.col("event_name").eq("stopDump")
+        )
+        .group_by("sequencer_name", "event_description", "iteration")
+        .agg(
+            start_time=pl.col("chronobox_time").filter(
+                pl.col("event_name") == "startDump"
+            ),
+            stop_time=pl.col("chronobox_time").filter(
+                pl.col("event_name") == "stopDump"
+            ),
+        )
+        .with_columns(
+            min_length=pl.min_horizontal(pl.col("start_time", "stop_time").list.len())
+        )
+        .filter(pl.col("min_length") > 0)
+        .with_columns(pl.col("start_time", "stop_time").list.head("min_length"))
+        .explode("start_time", "stop_time")
+        .drop("iteration", "min_length")
+    )
+
+
+def chronobox_counts(
+    chunks: Iterable[pl.DataFrame], channels_df: pl.DataFrame, windows_df: pl.DataFrame
+) -> pl.DataFrame:
+    """Count the Chronobox hits of every channel within every window.
+
+    `chunks` are board,channel,chronobox_time DataFrames with all the leading
+    edges, in any order and split in any way. Returns `windows_df` with an extra
+    column (sorted by name) for each channel that has at least one hit.
+    """
+    # Ignore all channels that have duplicate names in the ODB just because it
+    # makes my life easier. The only really annoying thing would be to name the
+    # columns in the spill log for these duplicates, but it's just easier to
+    # make a habit of using unique names in the ODB.
+    names_df = (
+        channels_df.filter(~pl.col("duplicate"))
+        .sort("channel_name")
+        .with_row_index("column")
+    )
+    start_times = windows_df["start_time"].to_numpy()
+    stop_times = windows_df["stop_time"].to_numpy()
+    counts = np.zeros((windows_df.height, names_df.height), dtype=np.int64)
+    has_hits = np.zeros(names_df.height, dtype=bool)
+
+    for chunk in chunks:
+        hits = (
+            chunk.join(names_df, on=["board", "channel"], how="inner")
+            .select("column", "chronobox_time")
+            .sort("column", "chronobox_time")
+        )
+        if hits.height == 0:
+            continue
+        # Only the windows that overlap with this chunk can get new hits.
+        open_windows = np.nonzero(
+            (stop_times >= hits["chronobox_time"].min())
+            & (start_times <= hits["chronobox_time"].max())
+        )[0]
+        starts = start_times[open_windows]
+        stops = stop_times[open_windows]
+        # Each channel is a contiguous (and sorted) slice of `hits`, so the
+        # number of hits in a window is just the difference between the
+        # positions of its stop and start times within that slice. This avoids
+        # materializing all windows x channels combinations (and doesn't
+        # require to `explode` events in every window).
+        times = hits["chronobox_time"].to_numpy()
+        offset = 0
+        for column, length in hits.group_by("column", maintain_order=True).len().rows():
+            channel_times = times[offset : offset + length]
+            counts[open_windows, column] += np.searchsorted(
+                channel_times, stops, side="right"
+            ) - np.searchsorted(channel_times, starts, side="left")
+            has_hits[column] = True
+            offset += length
+
+    return windows_df.with_columns(
+        pl.Series(name, counts[:, column])
+        for column, name in names_df.select("column", "channel_name").rows()
+        if has_hits[column]
+    )
+
+
+def trg_approx_input(
+    chunks: Iterable[pl.DataFrame], windows_df: pl.DataFrame
+) -> pl.Series:
+    """Approximate number of TRG input counts within every window.
+
+    `chunks` are TRG scalers DataFrames, in any order and split in any way. The
+    approximation is the difference between the `input` counter of the first
+    readout after the start of the window and the last readout before its end.
+    """
+    start_times = windows_df["start_time"].to_numpy()
+    stop_times = windows_df["stop_time"].to_numpy()
+    first_time = np.full(windows_df.height, np.inf)
+    first_input = np.zeros(windows_df.height, dtype=np.int64)
+    last_time = np.full(windows_df.height, -np.inf)
+    last_input = np.zeros(windows_df.height, dtype=np.int64)
+
+    for chunk in chunks:
+        chunk = chunk.drop_nulls(["trg_time", "input"]).sort("trg_time")
+        if chunk.height == 0:
+            continue
+        times = chunk["trg_time"].to_numpy()
+        inputs = chunk["input"].to_numpy()
+
+        i = np.searchsorted(times, start_times, side="left")
+        found = i < len(times)
+        i = np.minimum(i, len(times) - 1)
+        better = found & (times[i] < first_time)
+        first_time[better] = times[i[better]]
+        first_input[better] = inputs[i[better]]
+
+        i = np.searchsorted(times, stop_times, side="right") - 1
+        found = i >= 0
+        i = np.maximum(i, 0)
+        better = found & (times[i] > last_time)
+        last_time[better] = times[i[better]]
+        last_input[better] = inputs[i[better]]
+
+    found = np.isfinite(first_time) & np.isfinite(last_time)
+    return pl.Series(
+        "trg_approx_input",
+        np.where(found, np.clip(last_input - first_input, 0, None), 0),
+    )
+
+
+def spill_log(
+    windows_df: pl.DataFrame,
+    channels_df: pl.DataFrame,
+    chronobox_chunks: Iterable[pl.DataFrame],
+    trg_chunks: Iterable[pl.DataFrame],
+) -> pl.DataFrame:
+    """Generate the spill log from the dump windows (see `dump_windows`).
+
+    See `chronobox_counts` and `trg_approx_input` for the expected chunks.
+    """
+    return (
+        chronobox_counts(chronobox_chunks, channels_df, windows_df)
+        .with_columns(trg_approx_input=trg_approx_input(trg_chunks, windows_df))
+        .sort("start_time", "stop_time")
+    )
+
+
+def run_spill_log(
+    sequencer_events_csv: str,
+    odb_json: str,
+    chronobox_csv: str,
+    trg_scalers_csv: str,
+    cache: Optional[ResultCache] = None,
+    streaming: bool = False,
+    chunk_size: int = 1_000_000,
+) -> pl.DataFrame:
+    """Generate the spill log of a single run from its files.
+
+    If `streaming` is true, the Chronobox and TRG files are processed in chunks
+    of `chunk_size` rows.
+    """
+    inputs = [sequencer_events_csv, odb_json, chronobox_csv, trg_scalers_csv]
+    if cache is not None:
+        key = cache.key("spill_log", inputs)
+        spill_log_df = cache.get(key)
+        if spill_log_df is not None:
+            return spill_log_df
+
+    channels_df = chronobox_channels(load_odb(odb_json, CHRONOBOX_CHANNELS_POINTERS))
+    windows_lf = dump_windows(scan_csv(sequencer_events_csv, SEQUENCER_EVENTS_SCHEMA))
+    if streaming:
+        windows_df = windows_lf.collect()
+        chronobox_chunks = iter_leading_edges(chronobox_csv, chunk_size)
+        trg_chunks = iter_csv_batches(
+            trg_scalers_csv, chunk_size, TRG_SCALERS_SCHEMA, columns=TRG_SCALERS_COLUMNS
+        )
+    else:
+        # Collect all inputs in a single query so the scans run concurrently,
+        # and only the TRG columns that are actually used get parsed.
+        windows_df, chronobox_df, trg_scalers_df = pl.collect_all(
+            [
+                windows_lf,
+                scan_leading_edges(chronobox_csv),
+                scan_csv(trg_scalers_csv, TRG_SCALERS_SCHEMA, TRG_SCALERS_COLUMNS),
+            ]
+        )
+        chronobox_chunks = [chronobox_df]
+        trg_chunks = [trg_scalers_df]
+
+    spill_log_df = spill_log(windows_df, channels_df, chronobox_chunks, trg_chunks)
+    if cache is not None:
+        cache.put(key, spill_log_df)
+    return spill_log_df
@@ -0,0 +1,127 @@
+from typing import Optional
+import numpy as np
+import os
+import polars as pl
+import zipfile
+from utils.memory import memory_cache
+from utils.readers import (
+    check_header,
+    iter_data_blocks,
+    is_compressed,
+    parse_block,
+    scan_csv,
+)
+
+# The CSV files are written (roughly) in time order, so we keep the time range of
+# every block of this many bytes. Reading a small time window then only needs
+# to parse the few blocks that overlap with it.
+_BLOCK_SIZE = 1 << 18
+# Overlapping blocks are parsed together in reads of up to this many bytes.
+_READ_SIZE = 1 << 24
+
+
+def _index_path(path: str) -> str:
+    return path + ".index.npz"
+
+
+def build_time_index(path: str, schema: dict, time_column: str) -> dict:
+    """Find the byte range and time range of every block in a CSV file.
+
+    The index is written next to the CSV file (if possible), and it is stale as
+    soon as the size or modification time of the CSV file changes.
+    """
+    stat = os.stat(path)
+    starts, stops, t_min, t_max = [], [], [], []
+    with open(path, "rb") as f:
+        for offset, block in iter_data_blocks(f, _BLOCK_SIZE):
+            times = parse_block(block, schema, [time_column])[time_column]
+            starts.append(offset)
+            stops.append(offset + len(block))
+            t_min.append(times.min())
+            t_max.append(times.max())
+
+    index = {
+        "size": np.int64(stat.st_size),
+        "mtime_ns": np.int64(stat.st_mtime_ns),
+        "time_column": np.str_(time_column),
+        "start": np.array(starts, dtype=np.int64),
+        "stop": np.array(stops, dtype=np.int64),
+        # A block without valid times never overlaps any window.
+        "t_min": np.array(t_min, dtype=np.float64),
+        "t_max": np.array(t_max, dtype=np.float64),
+    }
+    directory, name = os.path.split(_index_path(path))
+    tmp = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(f, **index)
+        os.replace(tmp, _index_path(path))
+    except OSError:
+        # e.g. a read-only directory. Still use the index for this run.
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+def load_time_index(path: str, schema: dict, time_column: str) -> dict:
+    """Load the time index of a CSV file (see `build_time_index`).
+
+    The index is (re)built if it doesn't exist or if it is stale.
+    """
+    stat = os.stat(path)
+    try:
+        with np.load(_index_path(path)) as npz:
+            index = dict(npz)
+        if (
+            index["size"] == stat.st_size
+            and index["mtime_ns"] == stat.st_mtime_ns
+            and index["time_column"] == time_column
+        ):
+            return index
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # Missing or corrupt (e.g. truncated by an interrupted write).
+        pass
+
+    return build_time_index(path, schema, time_column)
+
+
+def read_time_range(
+    path: str,
+    schema: dict,
+    time_column: str,
+    t_min: float,
+    t_max: float,
+    columns: Optional[list[str]] = None,
+) -> pl.DataFrame:
+    """Read all rows of a CSV file with times within [t_min, t_max].
+
+    Only the blocks that can contain such rows are parsed (see
+    `build_time_index`), a few at a time, and only the rows within the window
+    and the given `columns` (all by default) are kept from each of them.
+    Compressed files can't be indexed, so they are scanned completely (and so
+    are files that are kept in memory anyway, see `utils.memory.MemoryCache`).
+    """
+    columns = list(schema) if columns is None else columns
+    in_window = pl.col(time_column).is_between(t_min, t_max)
+    if is_compressed(path) or memory_cache() is not None:
+        return scan_csv(path, schema, columns, in_window).collect()
+
+    check_header(path, schema)
+    index = load_time_index(path, schema, time_column)
+    overlaps = (index["t_max"] >= t_min) & (index["t_min"] <= t_max)
+    # Read contiguous blocks together, up to the block size of the reader.
+    ranges = []
+    for start, stop in zip(index["start"][overlaps], index["stop"][overlaps]):
+        if ranges and ranges[-1][1] == start and stop - ranges[-1][0] <= _READ_SIZE:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+
+    parsed = list(dict.fromkeys([*columns, time_column]))
+    dfs = [pl.DataFrame(schema={name: schema[name] for name in columns})]
+    with open(path, "rb") as f:
+        for start, stop in ranges:
+            f.seek(start)
+            df = parse_block(f.read(stop - start), schema, parsed)
+            dfs.append(df.filter(in_window).select(columns))
+    return pl.concat(dfs)
@@ -0,0 +1,166 @@
+import numpy as np
+import os
+import polars as pl
+from utils.readers import read_csv
+from utils.schemas import VERTICES_SCHEMA
+from utils.time_index import read_time_range
+
+# All 2D histograms as (name, x coordinate, y coordinate). The 1D histograms
+# of each coordinate are just their marginals.
+HISTOGRAMS_2D = [("t_z", "t", "z"), ("phi_r", "phi", "r")]
+# The only columns needed by `select_vertices`.
+_VERTICES_COLUMNS = [
+    "trg_time",
+    "reconstructed_x",
+    "reconstructed_y",
+    "reconstructed_z",
+]
+
+
+def select_vertices(
+    df: pl.DataFrame, limits: dict[str, tuple[float, float]]
+) -> pl.DataFrame:
+    """Select the vertices within `limits` (inclusive).
+
+    `df` is a vertices DataFrame (see `VERTICES_SCHEMA`), and `limits` has the
+    (min, max) of every coordinate: t, z, phi, and r. Returns a t,z,phi,r
+    DataFrame.
+    """
+    # The coordinates are stored as Float32, but e.g. `arctan2` in Float32 can
+    # round just outside of the default limits (-pi for y = -0.0).
+    x, y = (
+        pl.col("reconstructed_x").cast(pl.Float64),
+        pl.col("reconstructed_y").cast(pl.Float64),
+    )
+    return (
+        df.select(
+            t="trg_time",
+            z=pl.col("reconstructed_z").cast(pl.Float64),
+            phi=pl.arctan2(y, x),
+            r=(x.pow(2) + y.pow(2)).sqrt(),
+        )
+        .filter(
+            pl.col(name).is_between(low, high) for name, (low, high) in limits.items()
+        )
+        .select("t", "z", "phi", "r")
+    )
+
+
+def read_vertices(
+    path: str, limits: dict[str, tuple[float, float]], time_index: bool = False
+) -> pl.DataFrame:
+    """Read a vertices CSV file and select the vertices within `limits`.
+
+    See `select_vertices`. If `time_index` is true, only the part of the file
+    within the `t` limits is parsed (see `utils.time_index`).
+    """
+    if time_index:
+        df = read_time_range(
+            path, VERTICES_SCHEMA, "trg_time", *limits["t"], _VERTICES_COLUMNS
+        )
+    else:
+        df = read_csv(path, VERTICES_SCHEMA, _VERTICES_COLUMNS)
+    return select_vertices(df, limits)
+
+
+def bin_indices(values: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Bin index of every value within `edges` (-1 if it is outside of them).
+
+    Same bins as `np.histogram`, i.e. all bins are half-open except the last
+    one, and values outside of the edges (or NaN) are not in any bin.
+    """
+    indices = np.searchsorted(edges, values, side="right") - 1
+    indices[values == edges[-1]] = len(edges) - 2
+    indices[~((values >= edges[0]) & (values <= edges[-1]))] = -1
+    return indices
+
+
+def vertex_histograms(
+    df: pl.DataFrame, edges: dict[str, np.ndarray]
+) -> dict[str, np.ndarray]:
+    """Histogram the selected vertices (see `select_vertices`).
+
+    Returns all `HISTOGRAMS_2D` with the given `edges` of each coordinate. Each
+    column is converted to NumPy once (zero-copy), and every 2D histogram is a
+    single `np.bincount` over the flattened (x, y) bin indices.
+    """
+    indices = {name: bin_indices(df[name].to_numpy(), edges[name]) for name in edges}
+    # Same as `np.histogram`, vertices outside of the edges are just dropped.
+    inside = np.logical_and.reduce([i >= 0 for i in indices.values()])
+    hists = {}
+    for name, x, y in HISTOGRAMS_2D:
+        nx, ny = len(edges[x]) - 1, len(edges[y]) - 1
+        hists[name] = np.bincount(
+            indices[x][inside] * ny + indices[y][inside], minlength=nx * ny
+        ).reshape(nx, ny)
+    return hists
+
+
+def marginal(hists: dict[str, np.ndarray], coordinate: str) -> np.ndarray:
+    """1D histogram of a single coordinate from the 2D histograms."""
+    for name, x, y in HISTOGRAMS_2D:
+        if coordinate == x:
+            return hists[name].sum(axis=1)
+        if coordinate == y:
+            return hists[name].sum(axis=0)
+    raise ValueError(f"unknown coordinate `{coordinate}`")
+
+
+def run_histograms(
+    path: str, edges: dict[str, np.ndarray], time_index: bool = False
+) -> dict[str, np.ndarray]:
+    """Histogram all the vertices in a CSV file within the `edges`.
+
+    See `vertex_histograms`. The edges also define which vertices are selected.
+    """
+    limits = {name: (e[0], e[-1]) for name, e in edges.items()}
+    return vertex_histograms(read_vertices(path, limits, time_index), edges)
+
+
+def merge_histograms(hists: list[dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+    """Combine the histograms of many runs (with the same edges)."""
+    return {name: sum(h[name] for h in hists) for name, _, _ in HISTOGRAMS_2D}
+
+
+def save_histograms(
+    path: str,
+    edges: dict[str, np.ndarray],
+    hists: dict[str, np.ndarray],
+    sources: list[str],
+):
+    """Save histograms (and the files they were made from) to an `.npz` file.
+
+    These are much smaller than the vertices themselves, and can be merged with
+    the histograms of other runs later on (see `load_histograms`).
+    """
+    with open(path, "wb") as f:
+        np.savez(
+            f,
+            **{f"edges_{name}": e for name, e in edges.items()},
+            **hists,
+            sources=np.array(sources, dtype=np.str_),
+        )
+
+
+def load_histograms(
+    path: str,
+) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray], list[str]]:
+    """Load the edges, histograms, and sources saved by `save_histograms`."""
+    with np.load(path) as npz:
+        edges = {
+            name.removeprefix("edges_"): npz[name]
+            for name in npz.files
+            if name.startswith("edges_")
+        }
+        hists = {name: npz[name] for name, _, _ in HISTOGRAMS_2D}
+        sources = npz["sources"].tolist()
+    return edges, hists, sources
+
+
+def same_edges(a: dict[str, np.ndarray], b: dict[str, np.ndarray]) -> bool:
+    return a.keys() == b.keys() and all(np.array_equal(a[k], b[k]) for k in a)
+
+
+def source_name(path: str) -> str:
+    """Name used to keep track of which files are already in a histogram."""
+    return os.path.abspath(path)
@@ -1,143 +1,256 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import math
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
-import polars as pl
-
-parser = argparse.ArgumentParser(
-    description="Visualize the reconstructed annihilation vertices for a single run",
-    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-)
-parser.add_argument("vertices_csv", help="path to the reconstructed vertices CSV file")
-parser.add_argument("--output", help="write output to `OUTPUT`")
-"""
-All default thresholds represent the detector dimensions.
-Some events are definitely reconstructed outside these thresholds, but we
-most likely just want to ignore them.
-"""
-parser.add_argument(
-    "--phi-bins", type=int, default=100, help="number of bins along phi"
-)
-parser.add_argument(
-    "--phi-max", type=float, default=math.pi, help="maximum azimuthal angle in radians"
-)
-parser.add_argument(
-    "--phi-min", type=float, default=-math.pi, help="minimum azimuthal angle in radians"
-)
-parser.add_argument("--r-bins", type=int, default=100, help="number of bins along r")
-parser.add_argument(
-    "--r-max", type=float, default=0.19, help="maximum radial coordinate in meters"
-)
-parser.add_argument(
-    "--r-min", type=float, default=0.0, help="minimum radial coordinate in meters"
-)
-parser.add_argument("--t-bins", type=int, default=100, help="number of bins along t")
-parser.add_argument(
-    "--t-max", type=float, default=float("inf"), help="maximum time in seconds"
-)
-parser.add_argument("--t-min", type=float, default=0.0, help="minimum time in seconds")
-parser.add_argument("--z-bins", type=int, default=100, help="number of bins along z")
-parser.add_argument(
-    "--z-max", type=float, default=1.152, help="maximum z coordinate in meters"
-)
-parser.add_argument(
-    "--z-min", type=float, default=-1.152, help="minimum z coordinate in meters"
-)
-args = parser.parse_args()
-
-df = (
-    pl.read_csv(args.vertices_csv, comment_prefix="#")
-    .with_columns(
-        phi=pl.arctan2("reconstructed_y", "reconstructed_x"),
-        r=(pl.col("reconstructed_x").pow(2) + pl.col("reconstructed_y").pow(2)).sqrt(),
-    )
-    .filter(
-        pl.col("trg_time").is_between(args.t_min, args.t_max),
-        pl.col("reconstructed_z").is_between(args.z_min, args.z_max),
-        pl.col("phi").is_between(args.phi_min, args.phi_max),
-        pl.col("r").is_between(args.r_min, args.r_max),
-    )
-)
-num_vertices = len(df)
-
-fig = plt.figure(figsize=(19, 10), dpi=100)
-
-ax = fig.add_subplot(231)
-z_edges, z_bin_width = np.linspace(
-    args.z_min, args.z_max, args.z_bins + 1, retstep=True
-)
-ax.hist(df["reconstructed_z"], bins=z_edges)
-ax.set(xlabel="z [m]", ylabel="Number of vertices")
-
-ax = fig.add_subplot(232)
-t_max = args.t_max if args.t_max < float("inf") else df["trg_time"].max()
-t_edges, t_bin_width = np.linspace(args.t_min, t_max, args.t_bins + 1, retstep=True)
-ax.hist(df["trg_time"], bins=t_edges)
-ax.set(xlabel="TRG time [s]", ylabel="Number of vertices")
-
-ax = fig.add_subplot(233)
-_, _, _, mesh = ax.hist2d(
-    df["trg_time"], df["reconstructed_z"], bins=[t_edges, z_edges], cmin=1
-)
-ax.set(xlabel="TRG time [s]", ylabel="z [m]")
-cbar = fig.colorbar(mesh)
-cbar.set_label("Number of vertices", rotation=270, labelpad=15)
-
-ax = fig.add_subplot(234)
-r_edges, r_bin_width = np.linspace(
-    args.r_min, args.r_max, args.r_bins + 1, retstep=True
-)
-hist, _, _ = ax.hist(df["r"], bins=r_edges)
-ax.set(xlabel="r [m]", ylabel="Number of vertices")
-ax = ax.twinx()
-ax.set(yticklabels=[])
-norm = hist / (math.pi * (r_edges[1:] ** 2 - r_edges[:-1] ** 2))
-ax.hist(r_edges[:-1], r_edges, weights=norm, histtype="step", color="tab:orange")
-ax.legend(
-    handles=[
-        matplotlib.lines.Line2D([], [], c="tab:orange", label="Radial density [a.u.]")
-    ]
-)
-
-ax = fig.add_subplot(235)
-phi_edges, phi_bin_width = np.linspace(
-    args.phi_min, args.phi_max, args.phi_bins + 1, retstep=True
-)
-ax.hist(df["phi"], bins=phi_edges)
-ax.set(xlabel="phi [rad]", ylabel="Number of vertices")
-
-axc = fig.add_subplot(236)
-axc.set(xlabel="x [m]", ylabel="y [m]")
-axc.set_aspect("equal")
-hist, _, _ = np.histogram2d(df["phi"], df["r"], bins=[phi_edges, r_edges])
-hist[hist < 1] = np.nan
-axc.set_xlim(-r_edges[-1], r_edges[-1])
-axc.set_ylim(-r_edges[-1], r_edges[-1])
-ax = fig.add_subplot(236, projection="polar")
-ax.set(xticklabels=[], yticklabels=[])
-ax.grid(False)
-X, Y = np.meshgrid(phi_edges, r_edges)
-pc = ax.pcolormesh(X, Y, hist.T)
-cbar = fig.colorbar(pc, ax=[ax, axc], location="right")
-cbar.set_label("Number of vertices", rotation=270, labelpad=15)
-
-text = "\n".join(
-    [
-        r"$\bf{Bin\ widths:}$",
-        r"$\Delta z$: {:.2E} m".format(z_bin_width),
-        r"$\Delta t$: {:.2E} s".format(t_bin_width),
-        r"$\Delta r$: {:.2E} m".format(r_bin_width),
-        r"$\Delta \phi$: {:.2E} rad".format(phi_bin_width),
-        "",
-        r"$\bf{Number\ of\ vertices:}$" + f" {num_vertices}",
-    ]
-)
-fig.text(0.005, 0.01, text)
-
-if args.output:
-    plt.savefig(args.output, bbox_inches="tight")
-else:
-    plt.show()
+import multiprocessing
+import os
+import sys
+
+# NumPy, Polars, and Matplotlib are only imported once the arguments are parsed,
+# so `--help` and usage errors return right away.
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Visualize the reconstructed annihilation vertices.
+Multiple runs are combined by adding up their histograms. Each input can be a
+vertices CSV file or histograms previously saved with --save-histograms. Without
+any binning options, the binning of the first `.npz` input is used; all of them
+must have the same binning.""",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "vertices_csv",
+        nargs="+",
+        help="path to the reconstructed vertices CSV file(s) (or `.npz` histograms)",
+    )
+    parser.add_argument("--output", help="write output to `OUTPUT`")
+    parser.add_argument(
+        "--save-histograms",
+        help="save the (combined) histograms to `SAVE_HISTOGRAMS` (`.npz`)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, help="number of files to process in parallel"
+    )
+    """
+    All default thresholds represent the detector dimensions.
+    Some events are definitely reconstructed outside these thresholds, but we
+    most likely just want to ignore them.
+    """
+    parser.add_argument(
+        "--phi-bins", type=int, default=100, help="number of bins along phi"
+    )
+    parser.add_argument(
+        "--phi-max",
+        type=float,
+        default=math.pi,
+        help="maximum azimuthal angle in radians",
+    )
+    parser.add_argument(
+        "--phi-min",
+        type=float,
+        default=-math.pi,
+        help="minimum azimuthal angle in radians",
+    )
+    parser.add_argument(
+        "--r-bins", type=int, default=100, help="number of bins along r"
+    )
+    parser.add_argument(
+        "--r-max", type=float, default=0.19, help="maximum radial coordinate in meters"
+    )
+    parser.add_argument(
+        "--r-min", type=float, default=0.0, help="minimum radial coordinate in meters"
+    )
+    parser.add_argument(
+        "--t-bins", type=int, default=100, help="number of bins along t"
+    )
+    parser.add_argument(
+        "--t-max", type=float, default=float("inf"), help="maximum time in seconds"
+    )
+    parser.add_argument(
+        "--t-min", type=float, default=0.0, help="minimum time in seconds"
+    )
+    parser.add_argument(
+        "--time-index",
+        action="store_true",
+        help="""only parse the part of the CSV file within [t-min, t-max] (uses a time
+index next to the CSV file, built if missing or outdated)""",
+    )
+    parser.add_argument(
+        "--z-bins", type=int, default=100, help="number of bins along z"
+    )
+    parser.add_argument(
+        "--z-max", type=float, default=1.152, help="maximum z coordinate in meters"
+    )
+    parser.add_argument(
+        "--z-min", type=float, default=-1.152, help="minimum z coordinate in meters"
+    )
+    args = parser.parse_args()
+
+    from utils.plotting import check_display, import_pyplot
+
+    check_display(parser, args.output is None and not args.save_histograms)
+
+    import numpy as np
+    from utils.vertices import (
+        load_histograms,
+        marginal,
+        merge_histograms,
+        read_vertices,
+        run_histograms,
+        same_edges,
+        save_histograms,
+        source_name,
+        vertex_histograms,
+    )
+
+    csv_files = [path for path in args.vertices_csv if not path.endswith(".npz")]
+    npz_files = [path for path in args.vertices_csv if path.endswith(".npz")]
+
+    loaded = [load_histograms(path) for path in npz_files]
+    binning_given = any(
+        getattr(args, f"{coordinate}_{name}")
+        != parser.get_default(f"{coordinate}_{name}")
+        for coordinate in ["t", "z", "phi", "r"]
+        for name in ["bins", "min", "max"]
+    )
+    vertices_df = None
+    if loaded and not binning_given:
+        # e.g. replotting saved histograms, or adding runs to them, without
+        # having to repeat their binning.
+        edges = loaded[0][0]
+    else:
+        if args.t_max < float("inf"):
+            t_max = args.t_max
+        elif len(args.vertices_csv) == 1 and csv_files and not args.save_histograms:
+            # The time axis of a single run can just extend up to its last vertex.
+            vertices_df = read_vertices(
+                csv_files[0],
+                {
+                    "t": (args.t_min, args.t_max),
+                    "z": (args.z_min, args.z_max),
+                    "phi": (args.phi_min, args.phi_max),
+                    "r": (args.r_min, args.r_max),
+                },
+                args.time_index,
+            )
+            t_max = vertices_df["t"].max()
+        else:
+            # Otherwise histograms from different runs would have different edges.
+            parser.error("--t-max is required to combine or save histograms")
+        edges = {
+            "t": np.linspace(args.t_min, t_max, args.t_bins + 1),
+            "z": np.linspace(args.z_min, args.z_max, args.z_bins + 1),
+            "phi": np.linspace(args.phi_min, args.phi_max, args.phi_bins + 1),
+            "r": np.linspace(args.r_min, args.r_max, args.r_bins + 1),
+        }
+    t_edges, z_edges, phi_edges, r_edges = (edges[c] for c in ["t", "z", "phi", "r"])
+
+    all_hists, sources = [], []
+    for path, (npz_edges, npz_hists, npz_sources) in zip(npz_files, loaded):
+        if not same_edges(edges, npz_edges):
+            parser.error(f"`{path}` has a different binning")
+        all_hists.append(npz_hists)
+        sources.extend(npz_sources)
+    # This makes it easy to add new runs to an existing `.npz` file.
+    for path in csv_files:
+        if source_name(path) in sources:
+            print(f"Ignoring `{path}` (already in the histograms).", file=sys.stderr)
+    csv_files = [path for path in csv_files if source_name(path) not in sources]
+
+    if vertices_df is not None:
+        all_hists.append(vertex_histograms(vertices_df, edges))
+    elif len(csv_files) == 1:
+        all_hists.append(run_histograms(csv_files[0], edges, args.time_index))
+    elif csv_files:
+        # Every worker would otherwise start a Polars thread pool as large as
+        # the whole machine. The workers have to be spawned (not forked)
+        # because Polars is not fork-safe.
+        jobs = max(1, min(args.jobs or os.cpu_count() or 1, len(csv_files)))
+        os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // jobs))
+        with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            all_hists.extend(
+                executor.map(
+                    run_histograms,
+                    csv_files,
+                    [edges] * len(csv_files),
+                    [args.time_index] * len(csv_files),
+                )
+            )
+    sources.extend(source_name(path) for path in csv_files)
+    hists = merge_histograms(all_hists)
+    num_vertices = int(hists["t_z"].sum())
+
+    if args.save_histograms:
+        save_histograms(args.save_histograms, edges, hists, sources)
+        if not args.output:
+            sys.exit()
+
+    plt = import_pyplot(args.output is None)
+    from matplotlib.lines import Line2D
+
+    fig = plt.figure(figsize=(19, 10), dpi=100)
+
+    ax = fig.add_subplot(231)
+    ax.stairs(marginal(hists, "z"), z_edges, fill=True)
+    ax.set(xlabel="z [m]", ylabel="Number of vertices")
+
+    ax = fig.add_subplot(232)
+    ax.stairs(marginal(hists, "t"), t_edges, fill=True)
+    ax.set(xlabel="TRG time [s]", ylabel="Number of vertices")
+
+    ax = fig.add_subplot(233)
+    hist = np.where(hists["t_z"] < 1, np.nan, hists["t_z"])
+    mesh = ax.pcolormesh(t_edges, z_edges, hist.T)
+    ax.set(xlabel="TRG time [s]", ylabel="z [m]")
+    cbar = fig.colorbar(mesh)
+    cbar.set_label("Number of vertices", rotation=270, labelpad=15)
+
+    ax = fig.add_subplot(234)
+    hist = marginal(hists, "r")
+    ax.stairs(hist, r_edges, fill=True)
+    ax.set(xlabel="r [m]", ylabel="Number of vertices")
+    ax = ax.twinx()
+    ax.set(yticklabels=[])
+    norm = hist / (math.pi * (r_edges[1:] ** 2 - r_edges[:-1] ** 2))
+    ax.stairs(norm, r_edges, color="tab:orange")
+    ax.legend(handles=[Line2D([], [], c="tab:orange", label="Radial density [a.u.]")])
+
+    ax = fig.add_subplot(235)
+    ax.stairs(marginal(hists, "phi"), phi_edges, fill=True)
+    ax.set(xlabel="phi [rad]", ylabel="Number of vertices")
+
+    axc = fig.add_subplot(236)
+    axc.set(xlabel="x [m]", ylabel="y [m]")
+    axc.set_aspect("equal")
+    hist = np.where(hists["phi_r"] < 1, np.nan, hists["phi_r"])
+    axc.set_xlim(-r_edges[-1], r_edges[-1])
+    axc.set_ylim(-r_edges[-1], r_edges[-1])
+    ax = fig.add_subplot(236, projection="polar")
+    ax.set(xticklabels=[], yticklabels=[])
+    ax.grid(False)
+    X, Y = np.meshgrid(phi_edges, r_edges)
+    pc = ax.pcolormesh(X, Y, hist.T)
+    cbar = fig.colorbar(pc, ax=[ax, axc], location="right")
+    cbar.set_label("Number of vertices", rotation=270, labelpad=15)
+
+    text = "\n".join(
+        [
+            r"$\bf{Bin\ widths:}$",
+            r"$\Delta z$: {:.2E} m".format(z_edges[1] - z_edges[0]),
+            r"$\Delta t$: {:.2E} s".format(t_edges[1] - t_edges[0]),
+            r"$\Delta r$: {:.2E} m".format(r_edges[1] - r_edges[0]),
+            r"$\Delta \phi$: {:.2E} rad".format(phi_edges[1] - phi_edges[0]),
+            "",
+            r"$\bf{Number\ of\ vertices:}$" + f" {num_vertices}",
+        ]
+    )
+    fig.text(0.005, 0.01, text)
+
+    if args.output:
+        plt.savefig(args.output, bbox_inches="tight")
+    else:
+        plt.show()
@@ -0,0 +1,198 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+
+import polars as pl  # noqa: E402
+from polars.testing import assert_frame_equal  # noqa: E402
+from utils.chronobox import (  # noqa: E402
+    CHRONOBOX_CHANNELS_POINTERS,
+    chronobox_channels,
+    read_leading_edges,
+)
+from utils.constants import KNOWN_CHRONOBOXES  # noqa: E402
+from utils.follow import SpillLogFollower  # noqa: E402
+from utils.odb import load_odb  # noqa: E402
+from utils.readers import read_csv  # noqa: E402
+from utils.schemas import TRG_SCALERS_SCHEMA  # noqa: E402
+from utils.sequencer import read_sequencer_csv, sequencer_events  # noqa: E402
+from utils.spill_log import dump_windows, spill_log  # noqa: E402
+
+MIDAS_OFFSET = 1_700_000_000
+DURATION = 900.0
+STEP = 7.0
+
+SEQUENCERS = {"cat": "cb01", "rct": "cb02"}
+
+
+def _xml(name: str, dumps: list[tuple[str, str]]) -> str:
+    events = "".join(
+        f"<event><name>{event}</name><description>&quot;{description}&quot;"
+        "</description></event>"
+        for event, description in dumps
+    )
+    return (
+        f"<SequencerXML><SequencerName>{name}</SequencerName>"
+        f"<events>{events}</events></SequencerXML>"
+    )
+
+
+def _make_run(seed: int):
+    """Return the ODB, and the (time, line) rows of the other files.
+
+    Every iteration dumps with different descriptions, and some are stopped
+    early, so markers attributed to the wrong iteration show up in the spill
+    log.
+    """
+    rng = random.Random(seed)
+    names = {
+        board: [f"{board.upper()}_CH{c}" for c in range(59)]
+        for board in KNOWN_CHRONOBOXES
+    }
+    for sequencer, board in SEQUENCERS.items():
+        prefix = sequencer.upper()
+        names[board][:3] = [
+            f"{prefix}_SEQ_RUNNING",
+            f"{prefix}_START_DUMP",
+            f"{prefix}_STOP_DUMP",
+        ]
+    odb = {
+        "Equipment": {
+            board: {"Settings": {"names": names[board]}} for board in KNOWN_CHRONOBOXES
+        }
+    }
+
+    sequencer_rows, chronobox_rows = [], []
+    t = 10.0
+    iteration = 0
+    while t < DURATION - 60:
+        iteration += 1
+        sequencer = rng.choice(list(SEQUENCERS))
+        board = SEQUENCERS[sequencer]
+        dumps = []
+        for dump in rng.sample("ABCDEF", rng.randint(1, 3)):
+            description = f"Dump {dump}{iteration}"
+            dumps += [("startDump", description), ("stopDump", description)]
+        midas_timestamp = MIDAS_OFFSET + round(t + rng.uniform(-2, 2))
+        xml = _xml(sequencer, dumps).replace('"', '""')
+        sequencer_rows.append((t, f'{midas_timestamp},"{xml}"\n'))
+
+        chronobox_rows.append((t, f"{board},0,true,{t!r}\n"))
+        event_time = t + 1
+        # Some sequences are stopped before all their dumps.
+        if rng.random() < 0.3:
+            dumps = dumps[: 2 * rng.randint(0, len(dumps) // 2 - 1)]
+        for event, _ in dumps:
+            channel = 1 if event == "startDump" else 2
+            chronobox_rows.append(
+                (event_time, f"{board},{channel},true,{event_time!r}\n")
+            )
+            event_time += rng.uniform(0.5, 3)
+        t += rng.uniform(12, 30)
+    for _ in range(3000):
+        hit_time = rng.uniform(0, DURATION)
+        board = rng.choice(KNOWN_CHRONOBOXES)
+        chronobox_rows.append(
+            (hit_time, f"{board},{rng.randint(3, 8)},true,{hit_time!r}\n")
+        )
+    chronobox_rows.sort()
+
+    trg_rows = []
+    counter = 0
+    for serial_number in range(int(DURATION * 10)):
+        counter += rng.randint(0, 100)
+        trg_time = serial_number / 10
+        trg_rows.append(
+            (
+                trg_time,
+                f"{serial_number},{trg_time!r},{counter},0,0,0,{counter // 10}\n",
+            )
+        )
+    return odb, sequencer_rows, chronobox_rows, trg_rows
+
+
+class SpillLogFollowerTest(unittest.TestCase):
+    def _check_against_batch(self, sequencer_lag: float):
+        odb, sequencer_rows, chronobox_rows, trg_rows = _make_run(seed=1)
+        headers = {
+            "sequencer.csv": "midas_timestamp,xml\n",
+            "chronobox.csv": "board,channel,leading_edge,chronobox_time\n",
+            "trg.csv": "serial_number,trg_time,input,drift_veto,scaledown,pulser,output\n",
+        }
+        # The sequencer XMLs show up `sequencer_lag` seconds after their
+        # sequence started.
+        files = {
+            "sequencer.csv": [(t + sequencer_lag, line) for t, line in sequencer_rows],
+            "chronobox.csv": chronobox_rows,
+            "trg.csv": trg_rows,
+        }
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = {name: os.path.join(directory, name) for name in files}
+            for name, path in paths.items():
+                with open(path, "w") as f:
+                    f.write(headers[name])
+            odb_json = os.path.join(directory, "odb.json")
+            with open(odb_json, "w") as f:
+                json.dump(odb, f)
+
+            follower = SpillLogFollower(
+                paths["sequencer.csv"],
+                odb_json,
+                paths["chronobox.csv"],
+                paths["trg.csv"],
+            )
+            written = dict.fromkeys(files, 0)
+            rows = []
+            now = 0.0
+            while now < DURATION + STEP:
+                now += STEP
+                for name, path in paths.items():
+                    new_lines = [
+                        line for t, line in files[name][written[name] :] if t <= now
+                    ]
+                    written[name] += len(new_lines)
+                    with open(path, "a") as f:
+                        f.writelines(new_lines)
+                rows.append(follower.refresh())
+            rows.append(follower.refresh(final=True))
+            followed_df = pl.concat(rows).sort("start_time", "stop_time")
+
+            channels_df = chronobox_channels(
+                load_odb(odb_json, CHRONOBOX_CHANNELS_POINTERS)
+            )
+            chronobox_df = read_leading_edges(paths["chronobox.csv"])
+            windows_df = dump_windows(
+                sequencer_events(
+                    read_sequencer_csv(paths["sequencer.csv"]),
+                    chronobox_df,
+                    channels_df,
+                )
+            )
+            batch_df = spill_log(
+                windows_df,
+                channels_df,
+                [chronobox_df],
+                [read_csv(paths["trg.csv"], TRG_SCALERS_SCHEMA)],
+            )
+
+        self.assertGreater(batch_df.height, 50)
+        self.assertEqual(followed_df.height, batch_df.height)
+        # The follower has a column for every channel, the batch spill log only
+        # for the channels with hits.
+        followed_df = followed_df.select(batch_df.columns)
+        assert_frame_equal(followed_df, batch_df.cast(followed_df.schema))
+
+    def test_matches_batch(self):
+        self._check_against_batch(sequencer_lag=0.0)
+
+    def test_matches_batch_with_lagging_sequencer(self):
+        self._check_against_batch(sequencer_lag=17.0)
+
+
+if __name__ == "__main__":
+    unittest.main()